@@ -2,24 +2,41 @@
 import asyncio
 from datetime import timedelta
 import logging
+import time
 import voluptuous as vol
 import async_timeout
 
-from .dobiss import DobissSystem
+from .capture import CaptureWriter
+from .dobiss import AsyncDobissSystem, OutputRegistry, sceneRequests
 
 from homeassistant.config_entries import ConfigEntry
 from homeassistant.const import CONF_HOST, CONF_PORT, CONF_SCAN_INTERVAL
-from homeassistant.core import Config, HomeAssistant
+from homeassistant.core import Config, HomeAssistant, callback
 from homeassistant.exceptions import ConfigEntryNotReady
+from homeassistant.helpers import entity_registry
+from homeassistant.helpers.dispatcher import async_dispatcher_send
+from homeassistant.helpers.storage import Store
 from homeassistant.helpers.update_coordinator import DataUpdateCoordinator, UpdateFailed
 import homeassistant.helpers.config_validation as cv
 
-from .const import DOMAIN, PLATFORMS, DEFAULT_PORT, DEFAULT_SCAN_INTERVAL
+from .scheduler import PollScheduler
+
+from .const import DOMAIN, PLATFORMS, DEFAULT_PORT, DEFAULT_SCAN_INTERVAL, SCHEDULER_TICKS_PER_INTERVAL, STORAGE_VERSION, STORAGE_SAVE_DELAY
 
 
 _LOGGER = logging.getLogger(__name__)
 
 
+APPLY_SCENE_SCHEMA = vol.Schema({
+    vol.Optional("scene_id"): cv.string,
+    vol.Required("outputs"): { cv.entity_id: vol.All(vol.Coerce(int), vol.Range(min=0, max=100)) },
+})
+
+CAPTURE_SCHEMA = vol.Schema({
+    vol.Required("enabled"): cv.boolean,
+})
+
+
 # Validation of the user's configuration
 # PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
 #    vol.Required(CONF_HOST): cv.string,
@@ -61,23 +78,55 @@ async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry):
 
     # Create from config entry
     hass.data.setdefault(DOMAIN, {})
-    hass.data[DOMAIN][entry.entry_id] = entry.data;
 
-    await setupCoordinator(hass, host, port, update_interval)
+    coordinator = await setupCoordinator(hass, entry.entry_id, host, port, update_interval)
+
+    await migrateUniqueIds(hass, entry)
 
     for component in PLATFORMS:
         hass.async_create_task(
             hass.config_entries.async_forward_entry_setup(entry, component)
         )
-    
-    # Register service to re-import installation
-    coordinator = hass.data[DOMAIN]["coordinator"]
-    async def handle_importInstallation(call):
-        print("Importing Dobiss installation")
-        loop = asyncio.get_running_loop()
-        await loop.run_in_executor(None, coordinator.importInstallation)
 
-    hass.services.async_register(DOMAIN, "importInstallation", handle_importInstallation)
+    # Entities were created from the cached installation: check it against the controller in the background
+    if coordinator.loadedFromCache:
+        hass.async_create_task(coordinator.reimportInstallation())
+
+    # Register service to re-import the installations of all controllers
+    if not hass.services.has_service(DOMAIN, "importInstallation"):
+        async def handle_importInstallation(call):
+            print("Importing Dobiss installations")
+            await asyncio.gather(*[ coordinator.reimportInstallation() for coordinator in hass.data[DOMAIN].values() ])
+
+        hass.services.async_register(DOMAIN, "importInstallation", handle_importInstallation)
+
+    # Register service to set several outputs, possibly on several controllers, at once
+    if not hass.services.has_service(DOMAIN, "apply_scene"):
+        async def handle_applyScene(call):
+            registry = entity_registry.async_get(hass)
+
+            # The targets per controller
+            targets = { }
+            for entityId, value in call.data["outputs"].items():
+                entityEntry = registry.async_get(entityId)
+                coordinator = hass.data[DOMAIN].get(entityEntry.config_entry_id) if entityEntry else None
+                output = coordinator.outputByUniqueId(entityEntry.unique_id) if coordinator else None
+                if output is None:
+                    _LOGGER.warning(f"Ignoring {entityId} in Dobiss scene: not a Dobiss output")
+                    continue
+
+                targets.setdefault(coordinator, [ ]).append((output.moduleAddress, output.index, value))
+
+            await asyncio.gather(*[ coordinator.applyScene(call.data.get("scene_id"), sceneTargets) for coordinator, sceneTargets in targets.items() ])
+
+        hass.services.async_register(DOMAIN, "apply_scene", handle_applyScene, schema=APPLY_SCENE_SCHEMA)
+
+    # Register service to record the traffic with all controllers, to replay it with capture.py
+    if not hass.services.has_service(DOMAIN, "capture"):
+        async def handle_capture(call):
+            await asyncio.gather(*[ coordinator.setCapture(call.data["enabled"]) for coordinator in hass.data[DOMAIN].values() ])
+
+        hass.services.async_register(DOMAIN, "capture", handle_capture, schema=CAPTURE_SCHEMA)
 
     return True
 
@@ -96,77 +145,427 @@ async def async_unload_entry(hass: HomeAssistant, entry: ConfigEntry):
 
     cfg = hass.data.get(DOMAIN)
     _LOGGER.debug(f"{DOMAIN} hass data: {cfg}")
-    if unload_ok and cfg and cfg.get(entry.entry_id):
-        cfg.pop(entry.entry_id)
+    if unload_ok and cfg and entry.entry_id in cfg:
+        await cfg.pop(entry.entry_id).dobiss.close()
 
-    return unload_ok
+    if unload_ok and not cfg:
+        hass.services.async_remove(DOMAIN, "importInstallation")
+        hass.services.async_remove(DOMAIN, "apply_scene")
+        hass.services.async_remove(DOMAIN, "capture")
 
+    return unload_ok
 
-async def setupCoordinator(hass, host, port, update_interval):
 
-    _LOGGER.info(f"Creating update coordinator")
-    if DOMAIN in hass.data:
-        domainData = hass.data[DOMAIN]
-        if "coordinator" in domainData:
-            _LOGGER.warning("Warning: hass data already contains a coordinator. It will be overwritten!")
-        _LOGGER.debug(f"Current hass {DOMAIN} data: {str(domainData)}")
+async def setupCoordinator(hass, entryId, host, port, update_interval):
+    """Create the coordinator of a controller and store it by config entry.
+       Every controller has its own coordinator, connection and I/O worker, so the
+       controllers are polled concurrently and independently of each other.
+       Setup doesn't wait for the controller: the installation is imported (or the cached one is
+       refreshed) in the background, and the platforms add the entities as their modules come in.
+    """
+    _LOGGER.info(f"Creating update coordinator for {host}:{port}")
 
-    coordinator = DobissDataUpdateCoordinator(hass, host=host, port=port, update_interval=update_interval)
-    await coordinator.async_refresh()
+    coordinator = DobissDataUpdateCoordinator(hass, entryId, host=host, port=port, update_interval=update_interval)
+    await coordinator.loadCache()
 
     # Store the coordinator
-    hass.data[DOMAIN]["coordinator"] = coordinator
+    hass.data[DOMAIN][entryId] = coordinator
+
+    hass.async_create_task(coordinator.async_refresh())
 
     _LOGGER.debug(f"New hass {DOMAIN} data: {str(hass.data[DOMAIN])}")
 
-    return True
+    return coordinator
+
+
+async def migrateUniqueIds(hass, entry):
+    """Prefix the unique IDs of the outputs with the config entry, since the same output
+       address can exist on several controllers.
+    """
+    @callback
+    def migrate(entityEntry):
+        if entityEntry.unique_id.startswith(f"{entry.entry_id}_"):
+            return None
+        return { "new_unique_id": f"{entry.entry_id}_{entityEntry.unique_id}" }
+
+    await entity_registry.async_migrate_entries(hass, entry.entry_id, migrate)
 
 
 class DobissDataUpdateCoordinator(DataUpdateCoordinator):
     """Class to manage fetching Dobiss data from the LAN controller."""
 
-    def __init__(self, hass, host, port, update_interval):
+    def __init__(self, hass, entryId, host, port, update_interval):
         """Initialize."""
         _LOGGER.info(f"Initializing Dobiss System with host {host} and port {port}...")
-        self.dobiss = DobissSystem(host, port)
+        self.dobiss = AsyncDobissSystem(host, port, listen=True)
+        self.dobiss.onStatusReported = self.statusReported
+        self.entryId = entryId
+
+        # The outputs that were sent to the platforms, as (module address, output index)
+        self.outputsAddedSignal = f"{DOMAIN}_{entryId}_outputs_added"
+        self._announced = set()
+
+        # Seconds from creation until the first entities were announced and until the installation was imported
+        self._created = time.perf_counter()
+        self.startupTimings = { }
 
         self.setupCompleted = False
 
+        # Cache of the imported installation and the last known values
+        self._store = Store(hass, STORAGE_VERSION, f"{DOMAIN}.{host}_{port}")
+        self.loadedFromCache = False
+
+        # Snapshot of the values of the previous poll and the (module address, output index)
+        # keys that changed since then; None means all entities have to be updated
+        self._snapshot = { }
+        self.changedOutputs = None
+
+        # Modules to verify after a command, and the task that will do so
+        self._modulesToVerify = set()
+        self._verification = None
+
+        # The encoded action requests of every applied scene, as scene id: (targets, requests)
+        self._scenes = { }
+
+        # Every update is a tick of the scheduler: a fraction of the scan interval, in which only
+        # the modules that are due are polled. Modules are polled every scan interval at first and
+        # then faster or slower depending on how often they change, and a lot slower while the
+        # controller reports changes by itself.
+        self.scheduler = PollScheduler(SCHEDULER_TICKS_PER_INTERVAL)
+
         super().__init__(
             hass,
             _LOGGER,
-            name=DOMAIN,
-            update_interval=update_interval,
+            name=f"{DOMAIN} {host}:{port}",
+            update_interval=update_interval / SCHEDULER_TICKS_PER_INTERVAL,
         )
 
-    def importInstallation(self):
-        """Import installation"""
+    async def importInstallation(self):
+        """Import installation.
+           The outputs of every burst of imported modules are announced to the platforms right away.
+        """
         _LOGGER.info("Importing Dobiss installation...")
-        self.dobiss.connect()
-        self.dobiss.importFullInstallation()
+        await self.dobiss.importFullInstallation(pipelined=True, onModulesImported=self.modulesImported)
         _LOGGER.info("Importing Dobiss installation done")
 
-    async def async_setup(self):
-        """Setup in the background"""
-        loop = asyncio.get_running_loop()
-        result = await loop.run_in_executor(None, self.importInstallation)
-        print('default thread pool', result)
-        
+        # Don't overwrite the cache with a failed or partial import
+        if self.dobiss.modules and self.importComplete():
+            await self._store.async_save(self.dobiss.exportInstallation())
+
+    def importComplete(self):
+        """Whether every available module came in with its outputs and status.
+           Missing modules are imported again on a later update.
+        """
+        missingModules = self.dobiss.missingModules()
+        if missingModules:
+            _LOGGER.warning(f"Dobiss modules {missingModules} were not imported completely, trying again later")
+        return not missingModules
+
+    @callback
+    def modulesImported(self, moduleAddrs):
+        """Publish the values of newly imported modules and announce their outputs."""
+        self.publishValues()
+        self.announceOutputs()
+
+    @callback
+    def announceOutputs(self):
+        """Send the outputs that weren't announced yet to the platforms, which add their entities."""
+        outputs = [ output for output in self.dobiss.outputs if output.key not in self._announced ]
+        if not outputs:
+            return
+
+        if "firstEntity" not in self.startupTimings:
+            self.startupTimings["firstEntity"] = time.perf_counter() - self._created
+            _LOGGER.info(f"First Dobiss entities announced after {self.startupTimings['firstEntity'] * 1000:.0f} ms")
+
+        self._announced.update(output.key for output in outputs)
+        async_dispatcher_send(self.hass, self.outputsAddedSignal, outputs)
+
+    def announcedOutputs(self):
+        """The outputs that were announced to the platforms so far."""
+        return [ output for output in self.dobiss.outputs if output.key in self._announced ]
+
+    async def loadCache(self):
+        """Load the installation from the cache. Returns True if it was loaded."""
+        data = await self._store.async_load()
+        if not data:
+            return False
+
+        try:
+            self.dobiss.loadInstallation(data)
+        except (KeyError, TypeError, ValueError) as e:
+            _LOGGER.warning(f"Ignoring invalid Dobiss installation cache: {repr(e)}")
+            return False
+
+        _LOGGER.info(f"Loaded Dobiss installation with {len(self.dobiss.modules)} modules from the cache")
+        self.loadedFromCache = True
         self.setupCompleted = True
+
+        # The entities start with the cached values
+        self.data = self.dobiss.values.snapshot()
+        self.diffValues(self.data)
+        self.announceOutputs()
+        return True
+
+    async def reimportInstallation(self):
+        """Import the installation again, only adding, removing or renaming the entities of the
+           outputs that changed. Imports the full installation if there is none yet.
+           Returns True if the installation changed.
+        """
+        if not self.dobiss.modules:
+            await self.importInstallation()
+            return bool(self.dobiss.modules)
+
+        _LOGGER.info("Re-importing Dobiss installation...")
+        wasComplete = not self.dobiss.missingModules()
+        diff = await self.dobiss.reimportInstallation()
+        if diff is None:
+            _LOGGER.warning("Could not re-import the Dobiss installation")
+            return False
+
+        registry = entity_registry.async_get(self.hass)
+
+        # Remove the entities of outputs that are gone or changed type, and so platform
+        for output in diff['removed']:
+            key = output.key
+            self._announced.discard(key)
+            for entityId in self.entityIds(registry, *key):
+                registry.async_remove(entityId)
+
+        # Renamed outputs are updated in place, so their entities only have to be written
+        for output in diff['changed']:
+            for entityId in self.entityIds(registry, output.moduleAddress, output.index):
+                registry.async_update_entity(entityId, original_name=output.name)
+
+        # Forget the values of the modules that are gone or imported again
+        for moduleAddr in diff['modulesRemoved'] + diff['modulesChanged']:
+            self._snapshot.pop(moduleAddr, None)
+
+        self.publishValues()
+        self.announceOutputs()
+
+        if diff['changed']:
+            self.changedOutputs = { output.key for output in diff['changed'] }
+            self.async_update_listeners()
+
+        changed = bool(diff['added'] or diff['removed'] or diff['changed'])
+        if (changed or not wasComplete) and self.importComplete():
+            await self._store.async_save(self.dobiss.exportInstallation())
+
+        _LOGGER.info(f"Re-importing Dobiss installation done: {len(diff['added'])} outputs added, {len(diff['removed'])} removed, {len(diff['changed'])} renamed")
+        return changed
+
+    async def setCapture(self, enabled):
+        """Start recording all traffic with the controller to a capture file in the configuration directory,
+           replacing an earlier recording, or stop recording.
+        """
+        capture = None
+        if enabled:
+            path = self.hass.config.path(f"{DOMAIN}_{self.entryId}.cap")
+            capture = await self.hass.async_add_executor_job(CaptureWriter, path)
+            _LOGGER.info(f"Recording the traffic with the Dobiss controller at {self.dobiss.host}:{self.dobiss.port} to {path}")
+
+        self.dobiss.setCapture(capture)
+
+    def entityIds(self, registry, moduleAddr, index):
+        """The entity IDs of an output, on whichever platform it is."""
+        uniqueId = self.uniqueId(moduleAddr, index)
+        entityIds = [ registry.async_get_entity_id(platform, DOMAIN, uniqueId) for platform in PLATFORMS ]
+        return [ entityId for entityId in entityIds if entityId is not None ]
+
+    async def async_setup(self):
+        """Setup in the background. Tried again on the next update if the controller can't be reached.
+           Setup is completed as soon as there are modules; the modules that didn't come in completely
+           are imported again by later updates.
+        """
+        await self.importInstallation()
+
+        if self.dobiss.modules:
+            self.setupCompleted = True
+            self.startupTimings["fullImport"] = time.perf_counter() - self._created
+            _LOGGER.info(f"Dobiss installation with {len(self.dobiss.modules)} modules imported after {self.startupTimings['fullImport'] * 1000:.0f} ms")
     
     async def _async_update_data(self):
         """Query states"""
 
+        # Update everything unless the poll succeeds
+        self.changedOutputs = None
+
         # Setup if necessary
         if not self.setupCompleted:
             await self.async_setup()
-        
+
+            # Nothing to show yet: tried again on the next update, when the worker's backoff allows
+            if not self.setupCompleted:
+                raise UpdateFailed(f"Could not import the installation from the Dobiss controller at {self.dobiss.host}:{self.dobiss.port}")
+
+        # Import the modules that didn't come in completely again, once per interval
+        elif self.scheduler.tick % SCHEDULER_TICKS_PER_INTERVAL == 0 and self.dobiss.missingModules():
+            await self.reimportInstallation()
+
         # We use a time-out to be sure
         # Note: asyncio.TimeoutError and aiohttp.ClientError are already
         # handled by the data update coordinator.
-        async with async_timeout.timeout(10):
-            # Note: this is blocking
-            _LOGGER.debug("Requesting all statuses...")
-            self.dobiss.requestAllStatus()
-            _LOGGER.debug("Requesting all statuses done")
-            return self.dobiss.values
+        self.scheduler.setModules(self.dobiss.modules)
+        moduleAddrs = self.scheduler.advance()
+
+        # Poll everything on the first update and after a failure
+        sweep = self.data is None or not self.last_update_success or self.scheduler.tick == 1
+        if sweep:
+            moduleAddrs = list(self.dobiss.modules)
+
+        if moduleAddrs:
+            async with async_timeout.timeout(10):
+                _LOGGER.debug(f"Requesting statuses of modules {moduleAddrs}...")
+                await self.dobiss.requestModulesStatus(moduleAddrs)
+                _LOGGER.debug("Requesting statuses done")
+
+            if not self.dobiss.connected:
+                # Nothing is reported without a connection
+                self.scheduler.fallBack()
+                raise UpdateFailed(f"Lost connection to the Dobiss controller at {self.dobiss.host}:{self.dobiss.port}")
+
+        values = self.dobiss.values.snapshot()
+        changedOutputs = self.diffValues(values)
+
+        changedModules = { moduleAddr for moduleAddr, index in changedOutputs }
+        for moduleAddr in moduleAddrs:
+            self.scheduler.polled(moduleAddr, moduleAddr in changedModules, sweep)
+
+        # After a failed update or on the first update, all entities are updated
+        if self.data is not None and self.last_update_success:
+            self.changedOutputs = changedOutputs
+
+        # Keep the last known values in the cache, once the installation is complete
+        if changedOutputs and not self.dobiss.missingModules():
+            self._store.async_delay_save(self.dobiss.exportInstallation, STORAGE_SAVE_DELAY)
+
+        return values
+
+    @callback
+    def statusReported(self, moduleAddr):
+        """A module reported its status unsolicited: publish it right away, and poll the module less."""
+        self.scheduler.reported(moduleAddr)
+        self.publishValues()
+
+    async def applyCommand(self, moduleAddr, index, value, confirmed):
+        """Show the commanded value of an output right away if the controller echoed the command
+           (confirmed), and verify it with a status request for its module only, instead of
+           polling the whole installation.
+        """
+        if not confirmed:
+            _LOGGER.warning(f"Dobiss command for output {moduleAddr}.{index} was not confirmed by the controller, verifying it")
+        elif moduleAddr in self.dobiss.values:
+            self.dobiss.values.set(moduleAddr, index, value)
+            self.publishValues()
+
+        # Expect more activity on this module
+        self.scheduler.touch(moduleAddr)
+
+        await self.verifyModule(moduleAddr)
+
+    async def applyScene(self, sceneId, targets):
+        """Set several outputs at once: targets is a list of (module address, output index, value).
+           The actions are sent in one burst, encoded once per scene id, and all affected modules
+           are verified with one status request burst. The new values are only shown right away
+           if every action was echoed.
+        """
+        targets = sorted(targets)
+
+        scene = self._scenes.get(sceneId) if sceneId is not None else None
+        if scene is None or scene[0] != targets:
+            scene = (targets, sceneRequests(targets))
+            if sceneId is not None:
+                self._scenes[sceneId] = scene
+
+        # Show the new states, unless the controller didn't echo every action
+        if await self.dobiss.sendActionRequests(scene[1]):
+            for moduleAddr, index, value in targets:
+                if moduleAddr in self.dobiss.values:
+                    self.dobiss.values.set(moduleAddr, index, value)
+            self.publishValues()
+        else:
+            _LOGGER.warning(f"Dobiss scene {sceneId} was not confirmed by the controller, verifying its outputs")
+
+        # Verify them, which is coalesced into one burst
+        moduleAddrs = { moduleAddr for moduleAddr, index, value in targets }
+        for moduleAddr in moduleAddrs:
+            self.scheduler.touch(moduleAddr)
+        await asyncio.gather(*[ self.verifyModule(moduleAddr) for moduleAddr in moduleAddrs ])
+
+    async def verifyModule(self, moduleAddr):
+        """Request the status of a module.
+           Modules to verify within the action window (e.g. from a scene) are requested in one burst.
+        """
+        self._modulesToVerify.add(moduleAddr)
+        if self._verification is None:
+            self._verification = self.hass.async_create_task(self._verifyModules())
+
+        await asyncio.shield(self._verification)
+
+    async def _verifyModules(self):
+        await asyncio.sleep(self.dobiss.actionWindow)
+
+        moduleAddrs = self._modulesToVerify
+        self._modulesToVerify = set()
+        self._verification = None
+
+        await self.dobiss.requestModulesStatus(moduleAddrs, AsyncDobissSystem.Priority.Verify)
+        self.publishValues()
+
+    @callback
+    def publishValues(self):
+        """Publish the current values, updating only the entities whose value changed.
+           Unlike async_set_updated_data this leaves the refresh schedule and the result of the
+           last poll alone, so reports and commands don't hold up polling.
+        """
+        values = self.dobiss.values.snapshot()
+        changedOutputs = self.diffValues(values)
+        if not changedOutputs:
+            return
+
+        self.changedOutputs = changedOutputs
+        self.data = values
+        self.async_update_listeners()
+
+    def diffValues(self, values):
+        """Return the set of (module address, output index) whose value changed since the previous call."""
+        changed = set()
+
+        for moduleAddr, snapshot in values.items():
+            previous = self._snapshot.get(moduleAddr)
+
+            # Unchanged modules keep the same snapshot
+            if previous is snapshot or previous == snapshot:
+                continue
+
+            for index, value in enumerate(snapshot):
+                if previous is None or index >= len(previous) or previous[index] != value:
+                    changed.add((moduleAddr, index))
+
+            self._snapshot[moduleAddr] = snapshot
+
+        return changed
+
+    def uniqueId(self, moduleAddr, index):
+        """The unique ID of an output entity, which includes the config entry of the controller."""
+        return f"{self.entryId}_{OutputRegistry.uniqueId(moduleAddr, index)}"
+
+    def outputByUniqueId(self, uniqueId):
+        """The output of an entity unique ID, or None."""
+        prefix = f"{self.entryId}_"
+        if not uniqueId.startswith(prefix):
+            return None
+        return self.dobiss.outputs.byUniqueId(uniqueId[len(prefix):])
+
+    @callback
+    def async_update_listeners(self):
+        """Only update the entities whose output value changed, if known."""
+        if self.changedOutputs is None:
+            super().async_update_listeners()
+            return
+
+        _LOGGER.debug(f"Updating {len(self.changedOutputs)} changed outputs")
+        for update_callback, context in list(self._listeners.values()):
+            if context is None or context in self.changedOutputs:
+                update_callback()
@@ -0,0 +1,206 @@
+"""
+Benchmarks of the import, poll and action paths of DobissSystem against the simulated controller.
+
+Every case is run for each number of modules and each simulated round trip time, and reports the
+duration percentiles, frames per second and allocations. Run it with e.g.:
+    python benchmark.py --modules 1 8 32 82 --rtt 0 0.001 0.005 --output results.json
+and compare the results of two versions with:
+    python benchmark.py --compare before.json after.json
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import platform
+import statistics
+import threading
+import time
+import tracemalloc
+
+import dobiss
+from simulator import DobissSimulator, createModules
+
+
+class SimulatorThread:
+    """Runs a DobissSimulator on its own event loop, so the blocking DobissSystem can talk to it."""
+
+    def __init__(self, **kwargs):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target = self._loop.run_forever, daemon = True)
+        self._thread.start()
+        self.simulator = self._call(DobissSimulator(**kwargs).start())
+
+    def _call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def stop(self):
+        self._call(self.simulator.stop())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+
+def percentiles(durations):
+    """Duration statistics in milliseconds."""
+    durations = sorted(durations)
+    cuts = statistics.quantiles(durations, n = 100, method = 'inclusive') if len(durations) > 1 else durations * 99
+
+    return {
+        'mean': round(statistics.mean(durations) * 1000, 3),
+        'min': round(durations[0] * 1000, 3),
+        'max': round(durations[-1] * 1000, 3),
+        'p50': round(cuts[49] * 1000, 3),
+        'p95': round(cuts[94] * 1000, 3),
+        'p99': round(cuts[98] * 1000, 3)
+    }
+
+
+def allocations(function):
+    """The number of allocated blocks and the peak of traced memory of one call."""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        function()
+        current, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+
+    blocks = sum(max(stat.count_diff, 0) for stat in after.compare_to(before, 'lineno'))
+    return { 'blocks': blocks, 'peakBytes': peak }
+
+
+def runCase(system, function, iterations):
+    """Time a case and count its frames and allocations."""
+    # Warm up (connect, fill caches)
+    function()
+
+    framesBefore = system.metrics.framesSent
+    bytesBefore = system.metrics.bytesReceived
+    system.recvBuffer.resetStats()
+
+    durations = [ ]
+    for i in range(iterations):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+
+    total = sum(durations)
+    frames = system.metrics.framesSent - framesBefore
+
+    return {
+        'iterations': iterations,
+        'duration': percentiles(durations),
+        'framesPerIteration': frames / iterations,
+        'framesPerSecond': round(frames / total, 1) if total else None,
+        'bytesReceivedPerSecond': round((system.metrics.bytesReceived - bytesBefore) / total, 1) if total else None,
+        'recvBuffer': system.recvBuffer.stats,
+        'allocations': allocations(function)
+    }
+
+
+def benchmark(moduleCount, rtt, latency, iterations):
+    """Run all cases against a simulated installation of <moduleCount> modules."""
+    simulatorThread = SimulatorThread(modules = createModules(moduleCount), rtt = rtt, latency = latency)
+    system = dobiss.DobissSystem("127.0.0.1", simulatorThread.simulator.port)
+
+    results = { }
+    try:
+        # DobissSystem prints every imported module and output
+        with contextlib.redirect_stdout(io.StringIO()):
+            system.connect()
+            system.importFullInstallation(pipelined = True)
+
+            outputs = [ output.key for output in system.outputs ]
+            actions = [ (moduleAddr, index, dobiss.DobissSystem.Action.TurnOn, 100) for moduleAddr, index in outputs[:dobiss.MAX_BURST_SIZE] ]
+
+            cases = {
+                'import': lambda: system.importFullInstallation(pipelined = False),
+                'importPipelined': lambda: system.importFullInstallation(pipelined = True),
+                'poll': lambda: system.requestAllStatus(pipelined = False),
+                'pollPipelined': lambda: system.requestAllStatus(pipelined = True),
+                'action': lambda: system.sendAction(*actions[0]),
+                'actionBurst': lambda: system.sendActions(actions)
+            }
+
+            for name, function in cases.items():
+                results[name] = runCase(system, function, iterations)
+
+            results['failures'] = system.metrics.failures
+            results['lostResponses'] = system.parser.lostResponses
+
+    finally:
+        system.disconnect()
+        simulatorThread.stop()
+
+    return results
+
+
+def compare(beforePath, afterPath):
+    """Print the p50 duration of every case of two result files, and the change."""
+    with open(beforePath) as file:
+        before = json.load(file)
+    with open(afterPath) as file:
+        after = json.load(file)
+
+    beforeRuns = { (run['modules'], run['rtt'], run['latency']): run['cases'] for run in before['runs'] }
+
+    print(f"{'modules':>7} {'rtt':>7} {'case':16} {'before':>10} {'after':>10} {'change':>8}")
+    for run in after['runs']:
+        beforeCases = beforeRuns.get((run['modules'], run['rtt'], run['latency']))
+        if beforeCases is None:
+            continue
+
+        for name, case in run['cases'].items():
+            if not isinstance(case, dict) or name not in beforeCases:
+                continue
+
+            old = beforeCases[name]['duration']['p50']
+            new = case['duration']['p50']
+            change = f"{(new - old) / old * 100:+.0f}%" if old else ""
+            print(f"{run['modules']:>7} {run['rtt']:>7} {name:16} {old:>8.3f}ms {new:>8.3f}ms {change:>8}")
+
+
+def main(args):
+    results = {
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'iterations': args.iterations,
+        'runs': [ ]
+    }
+
+    for rtt in args.rtt:
+        for moduleCount in args.modules:
+            print(f"Benchmarking {moduleCount} modules with a round trip time of {rtt * 1000:g} ms...")
+            cases = benchmark(moduleCount, rtt, args.latency, args.iterations)
+            results['runs'].append({ 'modules': moduleCount, 'rtt': rtt, 'latency': args.latency, 'cases': cases })
+
+            for name, case in cases.items():
+                if isinstance(case, dict):
+                    print(f"    {name:16} p50 {case['duration']['p50']:8.3f} ms, p95 {case['duration']['p95']:8.3f} ms, "
+                          f"{case['framesPerSecond']:8.0f} frames/s, {case['allocations']['blocks']:6} blocks")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent = 2)
+        print(f"Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmarks of DobissSystem against the simulated controller")
+    parser.add_argument("--modules", type = int, nargs = "+", default = [ 1, 8, 32, 82 ], help = "numbers of modules (1-82)")
+    parser.add_argument("--rtt", type = float, nargs = "+", default = [ 0.0, 0.001, 0.005 ], help = "simulated round trip times in seconds")
+    parser.add_argument("--latency", type = float, default = 0.0, help = "simulated processing time per frame in seconds")
+    parser.add_argument("--iterations", type = int, default = 20)
+    parser.add_argument("--output", default = None, help = "file to save the results to, as JSON")
+    parser.add_argument("--compare", nargs = 2, metavar = ("BEFORE", "AFTER"), help = "compare two result files instead")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+    else:
+        main(args)
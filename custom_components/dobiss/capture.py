@@ -0,0 +1,216 @@
+"""
+Recording and replaying the traffic with a Dobiss LAN controller.
+
+A capture file starts with a header, followed by one record per sent or received chunk:
+    <direction: 'S' or 'R'> <timestamp: seconds since the start, double> <size: uint32> <data>
+all big-endian. Chunks are recorded exactly as they were sent and received, so a replay
+reproduces the chunking and timing of the real controller.
+
+Record with:
+    system.setCapture(CaptureWriter("traffic.cap"))
+(in Home Assistant, with the dobiss.capture service) and replay the requests of a capture
+through the response parser with e.g.:
+    python capture.py traffic.cap --speed 10 --listen
+"""
+
+import argparse
+import contextlib
+import io
+import socket
+import struct
+import time
+
+try:
+    from . import dobiss
+    from .codec import splitRequests
+except ImportError:
+    # Used outside of the integration package, e.g. to replay a capture from the command line
+    import dobiss
+    from codec import splitRequests
+
+MAGIC = b'DOBISSCAP\x01'
+SENT = b'S'
+RECEIVED = b'R'
+
+_RECORD = struct.Struct(">cdI")
+
+
+class CaptureWriter:
+    """Writes sent and received chunks to a capture file."""
+
+    def __init__(self, path):
+        self._file = open(path, "wb")
+        self._file.write(MAGIC)
+        self._start = time.monotonic()
+
+    def sent(self, data):
+        self._write(SENT, data)
+
+    def received(self, data):
+        self._write(RECEIVED, data)
+
+    def _write(self, direction, data):
+        self._file.write(_RECORD.pack(direction, time.monotonic() - self._start, len(data)))
+        self._file.write(data)
+
+    def close(self):
+        self._file.close()
+
+
+def readCapture(path):
+    """The records of a capture file, as (direction, timestamp, data)."""
+    records = [ ]
+    with open(path, "rb") as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a Dobiss capture")
+
+        while True:
+            header = file.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                break
+
+            direction, timestamp, size = _RECORD.unpack(header)
+            records.append((direction, timestamp, file.read(size)))
+
+    return records
+
+
+class ReplaySocket:
+    """A socket that answers with the received chunks of a capture.
+       Every send is aligned with the next recorded send, and the chunks received after it arrive
+       at their recorded time from there, divided by speed. With a speed of 0 they arrive right away.
+    """
+
+    def __init__(self, records, speed = 1.0):
+        self.speed = speed
+        self._sent = [ (timestamp, data) for direction, timestamp, data in records if direction == SENT ]
+        self._received = [ (timestamp, data) for direction, timestamp, data in records if direction == RECEIVED ]
+        self._nextSent = 0
+        self._nextReceived = 0
+        self._pending = b''
+        self._timeout = None
+
+        # The recorded time that corresponds to now
+        self._anchor = (time.monotonic(), 0.0)
+
+        # Sent data that differs from the capture
+        self.mismatches = 0
+
+    @property
+    def sentChunks(self):
+        """The recorded sent chunks, in order."""
+        return [ data for timestamp, data in self._sent ]
+
+    def settimeout(self, timeout):
+        self._timeout = timeout
+
+    def setsockopt(self, *args):
+        pass
+
+    def close(self):
+        pass
+
+    def sendall(self, data):
+        if self._nextSent < len(self._sent):
+            timestamp, recorded = self._sent[self._nextSent]
+            self._nextSent += 1
+            self._anchor = (time.monotonic(), timestamp)
+            if recorded != bytes(data):
+                self.mismatches += 1
+
+    def recv_into(self, view, size = 0):
+        size = size or len(view)
+
+        if not self._pending:
+            if self._nextReceived >= len(self._received):
+                # The end of the capture: the controller closed the connection
+                return 0
+
+            timestamp, data = self._received[self._nextReceived]
+
+            if self.speed:
+                now, recordedNow = self._anchor
+                wait = max(0.0, now + (timestamp - recordedNow) / self.speed - time.monotonic())
+                if self._timeout is not None and wait > self._timeout:
+                    time.sleep(self._timeout)
+                    raise socket.timeout("Timed out")
+                time.sleep(wait)
+
+            self._nextReceived += 1
+            self._pending = data
+
+        numBytes = min(size, len(self._pending))
+        view[:numBytes] = self._pending[:numBytes]
+        self._pending = self._pending[numBytes:]
+        return numBytes
+
+
+class ReplayDobissSystem(dobiss.DobissSystem):
+    """DobissSystem that talks to a recorded capture instead of a controller.
+       Drive it with the same calls as during the recording, or with replay().
+       When listening, unsolicited status reports are taken from the stream too, like Home Assistant does.
+    """
+
+    def __init__(self, path, speed = 1.0, timeout = dobiss.TIMEOUT, listen = False):
+        super().__init__("replay", 0, timeout)
+        self.records = readCapture(path)
+        self.speed = speed
+        self.replaySocket = None
+
+        if listen:
+            self.parser.onReport = self.parseReport
+
+    def parseReport(self, frame, statusData):
+        """Store an unsolicited status report of a module."""
+        module = self.modules.get(frame[3])
+        if module is not None:
+            self.values.allocate(module.address, module.outputCount)
+            self.values.update(module.address, statusData)
+
+    def connect(self):
+        """Start the replay from the beginning of the capture."""
+        self.disconnect()
+        self.socket = self.replaySocket = ReplaySocket(self.records, self.speed)
+        self._connected = True
+        self.backoff.connected()
+        return True
+
+    def replay(self):
+        """Send the recorded requests, chunk by chunk, and parse the responses.
+           Returns the number of requests and the number of complete responses.
+        """
+        self.connect()
+
+        numRequests = 0
+        numResponses = 0
+        for data in self.replaySocket.sentChunks:
+            requests = splitRequests(data)
+            numRequests += len(requests)
+            numResponses += sum(1 for response in self.requestBurst(requests) if response is not None)
+
+            if not self.connected:
+                break
+
+        return numRequests, numResponses
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Replay a Dobiss capture through the response parser")
+    parser.add_argument("path")
+    parser.add_argument("--speed", type = float, default = 1.0, help = "replay speed; 0 replays as fast as possible")
+    parser.add_argument("--listen", action = "store_true", help = "take unsolicited status reports from the stream, like Home Assistant")
+    args = parser.parse_args()
+
+    system = ReplayDobissSystem(args.path, args.speed, listen = args.listen)
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        numRequests, numResponses = system.replay()
+    duration = time.perf_counter() - start
+
+    stats = system.statistics()
+    print(f"Replayed {numRequests} requests in {duration * 1000:.1f} ms: {numResponses} responses, "
+          f"{stats['lostResponses']} lost, {stats['resyncs']} resyncs, {system.parser.reports} reports, {system.replaySocket.mismatches} mismatches")
+    for frameType, latency in stats['latency'].items():
+        if latency['count']:
+            print(f"    {frameType:8} {latency['count']:6} frames, p50 {latency['p50']} ms, p95 {latency['p95']} ms")
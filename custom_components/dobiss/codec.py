@@ -0,0 +1,180 @@
+"""
+Encoding and decoding of the 0xAF frames of the Dobiss LAN protocol.
+
+Requests are 16-byte frames:
+    AF <command> <type> <address> <4 parameter bytes> <size> FF FF FF FF FF FF AF
+An action request is followed by an 8-byte payload:
+    <address> <output> <action> <delay on> <delay off> <value> <soft dim> <red>
+
+The frames that only depend on the module (status requests and action headers) are encoded once,
+at import, and shared; the others are encoded with precompiled structs.
+"""
+
+import struct
+from functools import lru_cache
+
+FRAME_SIZE = 16
+ACTION_SIZE = 8
+OUTPUT_LINE_SIZE = 32
+MAX_MODULES = 82
+
+INSTALLATION = 0x0B
+MODULE = 0x10
+STATUS = 0x01
+ACTION = 0x02
+
+# Module types, as in DobissSystemBase.ModuleType
+MODULE_TYPES = (0x08, 0x10, 0x18)
+
+_REQUEST = struct.Struct(">9B6sB")
+_FILL = b'\xFF' * 6
+_ACTION = struct.Struct(">8B")
+
+# Module response: address, master flag, type
+_MODULE = struct.Struct(">Bx B11x Bx")
+# Output line: name, icon, group index
+_OUTPUT = struct.Struct(">30sBB")
+
+
+def paddedSize(size):
+    """The size of a frame as echoed by the controller: padded to a multiple of 32 bytes."""
+    return size + (32 - (size % 32)) % 32
+
+
+def frameType(data):
+    """The kind of request a frame is, for the metrics: 'status', 'action' or 'import'."""
+    if len(data) == ACTION_SIZE or data[1] == ACTION:
+        return 'action'
+    if data[1] == STATUS:
+        return 'status'
+    return 'import'
+
+
+def encodeRequest(command, moduleType, moduleAddr, p0, p1, p2, p3, size):
+    """Encode a 16-byte request frame."""
+    return _REQUEST.pack(0xAF, command, moduleType, moduleAddr, p0, p1, p2, p3, size, _FILL, 0xAF)
+
+
+_INSTALLATION_REQUEST = encodeRequest(INSTALLATION, 0x00, 0x00, 0x30, 0x00, 0x10, 0x01, 0x10)
+
+_STATUS_REQUESTS = {
+    (moduleType, moduleAddr): encodeRequest(STATUS, moduleType, moduleAddr, 0x00, 0x00, 0x00, 0x01, 0x00)
+    for moduleType in MODULE_TYPES for moduleAddr in range(1, MAX_MODULES + 1)
+}
+
+_ACTION_HEADERS = [
+    encodeRequest(ACTION, 0xFF, moduleAddr, 0x00, 0x00, 0x08, 0x01, 0x08)
+    for moduleAddr in range(0, MAX_MODULES + 1)
+]
+
+
+def installationRequest():
+    """Frame requesting the installation (which modules are present)."""
+    return _INSTALLATION_REQUEST
+
+def moduleRequest(moduleAddr):
+    """Frame requesting the type of a module."""
+    return encodeRequest(MODULE, 0xFF, moduleAddr, 0x00, 0x00, 0x10, 0x01, 0x10)
+
+def outputsRequest(moduleAddr, moduleType, outputCount):
+    """Frame requesting the names and icons of the outputs of a module."""
+    return encodeRequest(MODULE, moduleType, moduleAddr, 0x01, 0x00, 0x20, outputCount, 0x20)
+
+def statusRequest(moduleAddr, moduleType):
+    """Frame requesting the status of all outputs of a module."""
+    frame = _STATUS_REQUESTS.get((moduleType, moduleAddr))
+    if frame is None:
+        frame = encodeRequest(STATUS, moduleType, moduleAddr, 0x00, 0x00, 0x00, 0x01, 0x00)
+    return frame
+
+def actionHeader(moduleAddr):
+    """Header frame announcing an 8-byte action for a module."""
+    if moduleAddr <= MAX_MODULES:
+        return _ACTION_HEADERS[moduleAddr]
+    return encodeRequest(ACTION, 0xFF, moduleAddr, 0x00, 0x00, 0x08, 0x01, 0x08)
+
+@lru_cache(maxsize = 1024)
+def actionData(moduleAddr, outputIndex, action, value = 100, delayOn = 0xFF, delayOff = 0xFF, softDim = 0xFF, red = 0xFF):
+    """The 8-byte action payload that follows an action header.
+       Cached: the same few actions (on, off, a dim level) are sent to the same outputs over and over.
+    """
+    return _ACTION.pack(moduleAddr, outputIndex, action, delayOn, delayOff, int(value), softDim, red)
+
+
+def splitRequests(data):
+    """Split sent data into its (frame, responseSize) requests, e.g. to replay a capture.
+       Data that isn't a 16-byte frame is an 8-byte action payload: its header may have been sent separately.
+    """
+    requests = [ ]
+    offset = 0
+    while offset < len(data):
+        if data[offset] == 0xAF and offset + FRAME_SIZE <= len(data):
+            frame = bytes(data[offset:offset + FRAME_SIZE])
+            offset += FRAME_SIZE
+
+            if frame[1] == ACTION:
+                requests.append((frame, 0))
+            elif frame[1] == MODULE and frame[2] != 0xFF:
+                # Output names: one line per output
+                requests.append((frame, OUTPUT_LINE_SIZE * frame[7]))
+            else:
+                requests.append((frame, FRAME_SIZE))
+
+        elif offset + ACTION_SIZE <= len(data):
+            requests.append((bytes(data[offset:offset + ACTION_SIZE]), 0))
+            offset += ACTION_SIZE
+
+        else:
+            break
+
+    return requests
+
+
+def decodeInstallation(data):
+    """The addresses of the modules in an installation response.
+       The first 11 bytes (bits 0-81) contain whether or not there is a module with the specific address (1-82).
+    """
+    bits = int.from_bytes(data[0:11], 'little') & ((1 << MAX_MODULES) - 1)
+
+    moduleAddrs = [ ]
+    while bits:
+        # The lowest bit that is set; bit i is address i + 1
+        lowest = bits & -bits
+        moduleAddrs.append(lowest.bit_length())
+        bits ^= lowest
+    return moduleAddrs
+
+def decodeModule(data):
+    """(address, is master, module type) of a module response."""
+    moduleAddr, master, moduleType = _MODULE.unpack(data)
+    return moduleAddr, (master & 1) == 1, moduleType
+
+def decodeOutputs(data):
+    """(name, icon, group index) of every 32-byte line of an outputs response."""
+    return [ (name.strip().decode(), icon, groupIndex) for name, icon, groupIndex in _OUTPUT.iter_unpack(data) ]
+
+
+if __name__ == "__main__":
+    # Microbenchmark: cost per frame of encoding and decoding, compared to formatting hex strings
+    import timeit
+
+    moduleResponse = bytes([ 5, 0, 1 ] + [ 0 ] * 11 + [ 0x10, 0 ])
+    outputsResponse = b''.join(f"Output {i}".encode().ljust(30) + bytes((0, 0)) for i in range(12))
+    installationResponse = bytes([ 0xFF ] * 10 + [ 0x03 ] + [ 0 ] * 5)
+
+    benchmarks = [
+        ("status request (hex string)", lambda: bytearray.fromhex("AF 01 " + f"{0x10:02x}" + f"{5:02x}" + " 00 00 00 01 00 FF FF FF FF FF FF AF")),
+        ("status request (cached)", lambda: statusRequest(5, 0x10)),
+        ("status request (struct)", lambda: encodeRequest(STATUS, 0x10, 5, 0x00, 0x00, 0x00, 0x01, 0x00)),
+        ("action header (hex string)", lambda: bytearray.fromhex("AF 02 FF " + f"{5:02x}" + " 00 00 08 01 08 FF FF FF FF FF FF AF")),
+        ("action header (cached)", lambda: actionHeader(5)),
+        ("action payload (cached)", lambda: actionData(5, 1, 0x01, 100)),
+        ("outputs request (struct)", lambda: outputsRequest(5, 0x10, 4)),
+        ("installation response", lambda: decodeInstallation(installationResponse)),
+        ("module response", lambda: decodeModule(moduleResponse)),
+        ("outputs response (12 lines)", lambda: decodeOutputs(outputsResponse)),
+    ]
+
+    for name, function in benchmarks:
+        number, total = timeit.Timer(function).autorange()
+        print(f"{name:30} {total / number * 1e9:8.0f} ns per frame")
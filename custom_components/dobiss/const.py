@@ -2,7 +2,14 @@
 
 DOMAIN = "dobiss"
 # TODO ADD cover for up/down outputs
-PLATFORMS = ["light", "fan", "switch"]
+PLATFORMS = ["light", "fan", "switch", "sensor"]
 
 DEFAULT_PORT = 10001
 DEFAULT_SCAN_INTERVAL = 10
+
+# Modules are polled at their own rate, in ticks of a fraction of the scan interval
+SCHEDULER_TICKS_PER_INTERVAL = 5
+
+# Cache of the imported installation
+STORAGE_VERSION = 1
+STORAGE_SAVE_DELAY = 30
@@ -0,0 +1,25 @@
+"""Diagnostics of the Dobiss integration."""
+from homeassistant.config_entries import ConfigEntry
+from homeassistant.core import HomeAssistant
+
+from .const import DOMAIN
+
+
+async def async_get_config_entry_diagnostics(hass: HomeAssistant, entry: ConfigEntry):
+    """Return the performance counters of the connection to the controller."""
+    coordinator = hass.data[DOMAIN][entry.entry_id]
+    scheduler = coordinator.scheduler
+
+    return {
+        "entry": dict(entry.data),
+        "statistics": coordinator.dobiss.statistics(),
+        "lastUpdateSuccess": coordinator.last_update_success,
+        "loadedFromCache": coordinator.loadedFromCache,
+        "startupTimings": coordinator.startupTimings,
+        "scheduler": {
+            "tick": scheduler.tick,
+            "pollsPerTick": scheduler.pollsPerTick,
+            "reporting": scheduler.reporting,
+            "intervals": { str(moduleAddr): scheduler.interval(moduleAddr) for moduleAddr in coordinator.dobiss.modules if moduleAddr in scheduler }
+        }
+    }
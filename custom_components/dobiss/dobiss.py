@@ -2,16 +2,608 @@
 Helper module for communicating with a Dobiss home automation system.
 """
 
+import asyncio
 import socket
 import logging
 import time
+from dataclasses import dataclass
 from enum import IntEnum
+from types import MappingProxyType
+
+try:
+    from .codec import (FRAME_SIZE, STATUS, paddedSize, frameType, installationRequest, moduleRequest, outputsRequest, statusRequest,
+                        actionHeader, actionData, decodeInstallation, decodeModule, decodeOutputs)
+    from .metrics import DobissMetrics
+except ImportError:
+    # Used outside of the integration package, e.g. by test.py
+    from codec import (FRAME_SIZE, STATUS, paddedSize, frameType, installationRequest, moduleRequest, outputsRequest, statusRequest,
+                       actionHeader, actionData, decodeInstallation, decodeModule, decodeOutputs)
+    from metrics import DobissMetrics
 
 RECV_SIZE = 1024
+RECV_BUFFER_SIZE = 8192 # Holds a pipelined status poll of all 82 modules
 MAX_NUM_RETRIES = 10
 TIMEOUT = 1 # We can use a short timeout on the LAN
+ACTION_WINDOW = 0.02 # Actions within this many seconds are sent as one burst
+MAX_BURST_SIZE = 16 # Longer bursts are split, so more urgent requests can go in between
+BACKOFF_MIN = 0.5 # Delay before retrying after a failed connect, doubled on every failure...
+BACKOFF_MAX = 8 # ...up to this many seconds
+KEEPALIVE_IDLE = 10 # Probe an idle connection after this many seconds
+KEEPALIVE_INTERVAL = 2 # Time between keepalive probes
+KEEPALIVE_COUNT = 3 # Unanswered probes before the connection is considered dead
+
+# An unsolicited status report: a status frame and the status data, each padded like a response
+REPORT_STATUS_OFFSET = paddedSize(FRAME_SIZE)
+REPORT_SIZE = 2 * paddedSize(FRAME_SIZE)
+
+
+def enableKeepAlive(sock):
+    """Enable TCP keepalive on a socket, so a dead controller is noticed even when idle."""
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+    # Not all platforms allow tuning the keepalive timing
+    for option, value in (('TCP_KEEPIDLE', KEEPALIVE_IDLE), ('TCP_KEEPINTVL', KEEPALIVE_INTERVAL), ('TCP_KEEPCNT', KEEPALIVE_COUNT)):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+
+def receivedSize(response):
+    """The size of a response, where a lost response (None) has no data."""
+    return len(response) if response is not None else 0
+
+def allReceived(responses, requests):
+    """Whether a burst got a response to every one of its requests."""
+    return len(responses) == len(requests) and all(response is not None for response in responses)
+
+
+def actionRequests(moduleAddr, outputIndex, action, value = 100, delayOn = 0xFF, delayOff = 0xFF, softDim = 0xFF, red = 0xFF):
+    """The header and payload of an action as (frame, responseSize) requests for a burst.
+       Neither has response data: the controller only echoes them.
+    """
+    return [
+        (actionHeader(moduleAddr), 0),
+        (actionData(moduleAddr, outputIndex, action, value, delayOn, delayOff, softDim, red), 0)
+    ]
+
+def sceneRequests(targets):
+    """The action requests that set outputs to a value, for a burst.
+       targets is a list of (moduleAddr, outputIndex, value), where a value of 0 turns the output off.
+    """
+    return [
+        request
+        for moduleAddr, outputIndex, value in targets
+        for request in actionRequests(moduleAddr, outputIndex, DobissSystemBase.Action.TurnOn if value > 0 else DobissSystemBase.Action.TurnOff, value)
+    ]
+
+
+class RecvBuffer:
+    """Preallocated receive buffer.
+       Data is received in place with recv_into and consumed as memoryviews into the buffer,
+       so receiving a response doesn't allocate or copy. Unconsumed data is only moved to the
+       front when the end of the buffer is reached; the buffer only grows for a frame that doesn't fit.
+       A consumed view stays valid until the next receive.
+    """
+
+    def __init__(self, size = RECV_BUFFER_SIZE):
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+
+        self.resetStats()
+
+    def __len__(self):
+        return self._end - self._start
+
+    def resetStats(self):
+        """Reset the copy and allocation counters."""
+        self.copies = 0
+        self.copiedBytes = 0
+        self.allocations = 0
 
-class DobissSystem:
+    @property
+    def stats(self):
+        """The copy and allocation counters since the last reset."""
+        return {
+            'copies': self.copies,
+            'copiedBytes': self.copiedBytes,
+            'allocations': self.allocations
+        }
+
+    def clear(self):
+        """Drop all unconsumed data."""
+        self._start = 0
+        self._end = 0
+
+    def reserve(self, size):
+        """Make sure <size> bytes can be received without moving data."""
+        if self._end + size <= len(self._buffer):
+            return
+
+        pending = len(self)
+        if pending + size > len(self._buffer):
+            # Grow
+            newBuffer = bytearray(max(2 * len(self._buffer), pending + size))
+            newBuffer[:pending] = self._buffer[self._start:self._end]
+            self._buffer = newBuffer
+            self._view = memoryview(self._buffer)
+            self.allocations += 1
+        else:
+            # Move the unconsumed data to the front
+            self._buffer[:pending] = self._view[self._start:self._end]
+
+        self.copies += 1
+        self.copiedBytes += pending
+        self._start = 0
+        self._end = pending
+
+    def recvInto(self, sock, size = RECV_SIZE):
+        """Receive at most <size> bytes from a socket directly into the buffer."""
+        self.reserve(size)
+        numBytes = sock.recv_into(self._view[self._end:self._end + size])
+        self._end += numBytes
+        return numBytes
+
+    def feed(self, data):
+        """Append received data, for a transport that can't receive into the buffer itself."""
+        self.reserve(len(data))
+        self._view[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def peek(self):
+        """All unconsumed data, as a view into the buffer."""
+        return self._view[self._start:self._end]
+
+    def consume(self, size):
+        """Consume <size> bytes and return them as a view into the buffer."""
+        view = self._view[self._start:self._start + size]
+        self._start += size
+
+        # Start at the front again once everything is consumed
+        if self._start == self._end:
+            self._start = 0
+            self._end = 0
+
+        return view
+
+
+class ResponseParser:
+    """Incremental parser of the responses in a RecvBuffer.
+       The controller echoes every request padded to 32 bytes, followed by the response data padded to 32 bytes.
+       The echo is checked against the request. If it doesn't match (a stray byte, a short earlier response),
+       the parser resynchronizes on the echo of the request further on in the stream. If the echo of a later
+       request comes first, the response to this request was lost: only this request fails, and the next one
+       continues at that echo.
+
+       With onReport set, unsolicited status reports are taken from the stream as well: a status frame that
+       isn't the echo of this or a later request, followed by the status data, like a status response.
+       onReport is called with the frame and the status data, as views that are only valid during the call.
+    """
+
+    class Result(IntEnum):
+        """The outcome of parsing a response."""
+        Incomplete = 0
+        Complete = 1
+        Lost = 2
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.onReport = None
+        self.resyncs = 0
+        self.lostResponses = 0
+        self.skippedBytes = 0
+        self.reports = 0
+
+    @property
+    def stats(self):
+        """The resynchronization and report counters."""
+        return {
+            'resyncs': self.resyncs,
+            'lostResponses': self.lostResponses,
+            'skippedBytes': self.skippedBytes,
+            'reports': self.reports
+        }
+
+    def parse(self, data, responseSize, later = (), final = False):
+        """Parse the response to the request <data> from the buffered data.
+           later are the (frame, responseSize) requests sent after it, in order.
+           final means no more data arrives in time: data that can't be told from a report yet
+           is then taken as the responses, like without onReport.
+           Returns (result, response); response is a view into the buffer if the result is Complete.
+        """
+        echoSize = paddedSize(len(data))
+        totalSize = echoSize + paddedSize(responseSize)
+
+        pending = self.buffer.peek()
+        while self.onReport is not None:
+            report = self._startsWithReport(pending, data, later)
+            if report is None and final:
+                break
+            if report is None or (report and len(pending) < REPORT_SIZE):
+                return ResponseParser.Result.Incomplete, None
+            if not report:
+                break
+
+            self._takeReport()
+            pending = self.buffer.peek()
+
+        if len(pending) < len(data):
+            return ResponseParser.Result.Incomplete, None
+
+        if pending[:len(data)] != data:
+            # Out of sync: look for the first echo of this request or a later one
+            pendingBytes = bytes(pending)
+            offset = pendingBytes.find(data)
+            lost = False
+            for frame, size in later:
+                laterOffset = pendingBytes.find(frame)
+                if laterOffset != -1 and (offset == -1 or laterOffset < offset):
+                    offset = laterOffset
+                    lost = True
+
+            if offset == -1:
+                # Nothing to synchronize on yet: keep only what could be the start of an echo
+                self._skip(len(pending) - (FRAME_SIZE - 1))
+                return ResponseParser.Result.Incomplete, None
+
+            self._skip(offset)
+            self.resyncs += 1
+            if lost:
+                self.lostResponses += 1
+                return ResponseParser.Result.Lost, None
+
+            pending = self.buffer.peek()
+
+        if len(pending) < totalSize:
+            return ResponseParser.Result.Incomplete, None
+
+        response = self.buffer.consume(totalSize)
+        return ResponseParser.Result.Complete, response[echoSize:echoSize + responseSize]
+
+    def takeReports(self):
+        """Take the unsolicited reports from the buffered data, while no response is expected.
+           Data that can't be the start of a report is skipped.
+        """
+        while True:
+            pending = self.buffer.peek()
+            if len(pending) < FRAME_SIZE:
+                return
+
+            if self._startsWithReport(pending) is False:
+                offset = bytes(pending).find(b'\xAF', 1)
+                self._skip(offset if offset != -1 else len(pending))
+                continue
+
+            if len(pending) < REPORT_SIZE:
+                return
+            self._takeReport()
+
+    def _startsWithReport(self, pending, data = b'', later = ()):
+        """Whether the pending data starts with a report instead of the echo of the request <data>:
+           True, False, or None if it can't be told yet.
+           A report of a module whose status is requested later in the burst looks like the echo of
+           that request. It is only a report if the echo of this request follows it, possibly after
+           more status frames; if other data follows, or nothing but the responses to all later
+           requests in order, the response to this request was lost.
+        """
+        offset = 0
+        matched = 0
+        while True:
+            frame = pending[offset:offset + FRAME_SIZE]
+            if data and frame[:len(data)] == data:
+                return offset > 0
+            if len(frame) < FRAME_SIZE:
+                return None if offset else False
+            if not ResponseParser._isStatusFrame(frame):
+                return False
+            if not any(frame == request for request, size in later):
+                return True
+
+            if matched < len(later) and frame == later[matched][0]:
+                matched += 1
+            offset += REPORT_SIZE
+
+            if matched == len(later) and len(pending) == offset:
+                return False
+
+    @staticmethod
+    def _isStatusFrame(data):
+        return len(data) >= FRAME_SIZE and data[0] == 0xAF and data[1] == STATUS and data[FRAME_SIZE - 1] == 0xAF
+
+    def _takeReport(self):
+        report = self.buffer.consume(REPORT_SIZE)
+        self.reports += 1
+        self.onReport(report[:FRAME_SIZE], report[REPORT_STATUS_OFFSET:REPORT_STATUS_OFFSET + FRAME_SIZE])
+
+    def _skip(self, size):
+        if size > 0:
+            self.buffer.consume(size)
+            self.skippedBytes += size
+
+
+class ReconnectBackoff:
+    """Reconnect state machine with bounded exponential backoff.
+
+       Disconnected: a connect may be attempted right away.
+       Connected: after a successful connect; the delay is reset.
+       Waiting: after a failed connect, no new attempt is made for the current delay,
+                which doubles on every failure up to maxDelay.
+    """
+
+    class State(IntEnum):
+        Disconnected = 0
+        Connected = 1
+        Waiting = 2
+
+    def __init__(self, minDelay = BACKOFF_MIN, maxDelay = BACKOFF_MAX):
+        self.minDelay = minDelay
+        self.maxDelay = maxDelay
+
+        self.state = ReconnectBackoff.State.Disconnected
+        self.delay = minDelay
+        self.nextAttempt = 0
+        self.failures = 0
+        self.reconnects = 0
+        self._wasConnected = False
+
+    @property
+    def waitTime(self):
+        """Seconds to wait before the next connect attempt."""
+        if self.state != ReconnectBackoff.State.Waiting:
+            return 0
+        return max(0, self.nextAttempt - time.monotonic())
+
+    def connected(self):
+        """A connect succeeded."""
+        if self._wasConnected:
+            self.reconnects += 1
+        self._wasConnected = True
+
+        self.state = ReconnectBackoff.State.Connected
+        self.delay = self.minDelay
+        self.failures = 0
+
+    def lost(self):
+        """The connection was lost or closed: the next connect may be attempted right away."""
+        if self.state == ReconnectBackoff.State.Connected:
+            self.state = ReconnectBackoff.State.Disconnected
+
+    def failed(self):
+        """A connect failed: wait before the next attempt."""
+        self.failures += 1
+        self.state = ReconnectBackoff.State.Waiting
+        self.nextAttempt = time.monotonic() + self.delay
+        self.delay = min(self.maxDelay, 2 * self.delay)
+
+
+@dataclass(frozen = True, slots = True)
+class DobissModule:
+    """An imported module."""
+    address: int
+    type: 'DobissSystemBase.ModuleType'
+    isMaster: bool
+    outputCount: int
+
+
+@dataclass(slots = True)
+class DobissOutput:
+    """An imported output. Not frozen: a renamed output is changed in place by OutputRegistry.update."""
+    moduleAddress: int
+    index: int
+    name: str
+    type: 'DobissSystemBase.OutputType'
+    groupIndex: int
+
+    @property
+    def key(self):
+        """(module address, output index)"""
+        return (self.moduleAddress, self.index)
+
+
+class OutputRegistry:
+    """The imported outputs, indexed by (module address, output index), unique id, name, type, module and group.
+       Adding an output that already exists replaces it, so re-importing doesn't duplicate outputs.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        """Remove all outputs."""
+        self._outputs = { }
+        self._byUniqueId = { }
+        self._byName = { }
+        self._byType = { }
+        self._byModule = { }
+        self._byGroup = { }
+
+    def __len__(self):
+        return len(self._outputs)
+
+    def __iter__(self):
+        return iter(list(self._outputs.values()))
+
+    def __contains__(self, key):
+        return key in self._outputs
+
+    @staticmethod
+    def uniqueId(moduleAddr, index):
+        """The unique id of an output, as used for the Home Assistant entities."""
+        return f"{moduleAddr}.{index}"
+
+    def add(self, output):
+        """Add or replace an output."""
+        key = output.key
+        if key in self._outputs:
+            self.remove(*key)
+
+        self._outputs[key] = output
+        self._byUniqueId[OutputRegistry.uniqueId(*key)] = output
+        self._byName.setdefault(output.name, { })[key] = output
+        self._byType.setdefault(output.type, { })[key] = output
+        self._byModule.setdefault(output.moduleAddress, { })[key] = output
+        self._byGroup.setdefault(output.groupIndex, { })[key] = output
+
+    def remove(self, moduleAddr, index):
+        """Remove an output. Returns the removed output, or None if there was none."""
+        key = (moduleAddr, index)
+        output = self._outputs.pop(key, None)
+        if output is None:
+            return None
+
+        del self._byUniqueId[OutputRegistry.uniqueId(*key)]
+        for lookup, value in ((self._byName, output.name), (self._byType, output.type),
+                              (self._byModule, output.moduleAddress), (self._byGroup, output.groupIndex)):
+            outputs = lookup[value]
+            del outputs[key]
+            if not outputs:
+                del lookup[value]
+
+        return output
+
+    def removeModule(self, moduleAddr):
+        """Remove all outputs of a module. Returns the removed outputs."""
+        return [ self.remove(*key) for key in list(self._byModule.get(moduleAddr, { })) ]
+
+    def update(self, moduleAddr, index, **fields):
+        """Change fields of an output in place, so whoever holds the output sees the change.
+           Returns the output, or None if there is none.
+        """
+        output = self.remove(moduleAddr, index)
+        if output is None:
+            return None
+
+        for field, value in fields.items():
+            setattr(output, field, value)
+        self.add(output)
+        return output
+
+    def get(self, moduleAddr, index):
+        """The output at an index of a module, or None."""
+        return self._outputs.get((moduleAddr, index))
+
+    def byUniqueId(self, uniqueId):
+        """The output with a unique id, or None."""
+        return self._byUniqueId.get(uniqueId)
+
+    def byName(self, name):
+        """The outputs with a name (names are not necessarily unique)."""
+        return list(self._byName.get(name, { }).values())
+
+    def ofType(self, outputType):
+        """The outputs of a type."""
+        return list(self._byType.get(outputType, { }).values())
+
+    def ofModule(self, moduleAddr):
+        """The outputs of a module."""
+        return list(self._byModule.get(moduleAddr, { }).values())
+
+    def ofGroup(self, groupIndex):
+        """The outputs in a group."""
+        return list(self._byGroup.get(groupIndex, { }).values())
+
+
+class ValueStore:
+    """The output values: one preallocated bytearray per module, holding one byte per output.
+       A status response is stored with a single slice assignment. Readers get immutable snapshots;
+       the snapshot of a module is only rebuilt after its values changed.
+    """
+
+    def __init__(self):
+        self._slabs = { }
+        self._snapshots = { }
+        self._snapshot = None
+
+        # The modules whose values were stored, rather than only allocated
+        self._stored = set()
+
+    def __len__(self):
+        return len(self._slabs)
+
+    def __iter__(self):
+        return iter(self._slabs)
+
+    def __contains__(self, moduleAddr):
+        return moduleAddr in self._slabs
+
+    def __getitem__(self, moduleAddr):
+        return self.snapshot()[moduleAddr]
+
+    def __repr__(self):
+        return repr({ moduleAddr: list(values) for moduleAddr, values in self.snapshot().items() })
+
+    def items(self):
+        return self.snapshot().items()
+
+    def allocate(self, moduleAddr, outputCount):
+        """Make sure there is a slab for a module with <outputCount> outputs."""
+        slab = self._slabs.get(moduleAddr)
+        if slab is None or len(slab) != outputCount:
+            self._slabs[moduleAddr] = bytearray(outputCount)
+            self._stored.discard(moduleAddr)
+            self._invalidate(moduleAddr)
+        return self._slabs[moduleAddr]
+
+    def removeModule(self, moduleAddr):
+        """Forget the values of a module."""
+        self._stored.discard(moduleAddr)
+        if self._slabs.pop(moduleAddr, None) is not None:
+            self._invalidate(moduleAddr)
+
+    def stored(self, moduleAddr):
+        """Whether the values of a module were stored from a status response (or the cache)."""
+        return moduleAddr in self._stored
+
+    def update(self, moduleAddr, data):
+        """Store the values of a module from the start of a status response.
+           Returns True if any value changed.
+        """
+        slab = self._slabs[moduleAddr]
+        self._stored.add(moduleAddr)
+        data = data[:len(slab)]
+        if slab == data:
+            return False
+
+        slab[:] = data
+        self._invalidate(moduleAddr)
+        return True
+
+    def get(self, moduleAddr, index):
+        """The value of an output."""
+        return self._slabs[moduleAddr][index]
+
+    def set(self, moduleAddr, index, value):
+        """Set the value of an output. Returns True if it changed."""
+        slab = self._slabs[moduleAddr]
+        if slab[index] == value:
+            return False
+
+        slab[index] = value
+        self._invalidate(moduleAddr)
+        return True
+
+    def snapshot(self):
+        """An immutable snapshot of all values: a read-only mapping of module address to bytes.
+           The same object is returned as long as nothing changed.
+        """
+        if self._snapshot is None:
+            for moduleAddr, slab in self._slabs.items():
+                if moduleAddr not in self._snapshots:
+                    self._snapshots[moduleAddr] = bytes(slab)
+            self._snapshot = MappingProxyType(dict(self._snapshots))
+        return self._snapshot
+
+    def _invalidate(self, moduleAddr):
+        self._snapshots.pop(moduleAddr, None)
+        self._snapshot = None
+
+
+class DobissSystemBase:
+    """The installation as seen through a Dobiss LAN controller.
+       Holds the imported modules, outputs and values and parses the controller responses.
+       The actual I/O is done by the subclasses: DobissSystem (blocking socket) and
+       AsyncDobissSystem (asyncio streams).
+    """
 
     def __init__(self, host, port):
 
@@ -19,14 +611,21 @@ class DobissSystem:
         self._port = port
         self._connected = False
 
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        #self.socket.settimeout(TIMEOUT)
-        self.recvBuffer = bytearray()
-
         self.availableModules = [ ]
         self.modules = { }
-        self.outputs = [ ]
-        self.values = { }
+        self.outputs = OutputRegistry()
+        self.values = ValueStore()
+
+        # Duration of the phases of the last importFullInstallation
+        self.lastImportTimings = { }
+
+        # Receive buffer copies and allocations of the last status poll
+        self.lastPollStats = { }
+
+        self.metrics = DobissMetrics()
+
+        # Records all sent and received data if set, e.g. a capture.CaptureWriter
+        self.capture = None
 
     @property
     def host(self):
@@ -37,7 +636,7 @@ class DobissSystem:
     def port(self):
         """Return the port of this system."""
         return self._port
-    
+
     @property
     def connected(self):
         """True if the socket is connected"""
@@ -45,46 +644,279 @@ class DobissSystem:
 
     @property
     def lights(self):
-        result = [ ]
-        for output in self.outputs:
-            if output['type'] == DobissSystem.OutputType.Light:
-                result.append(output)
-
-        return result
+        return self.outputs.ofType(DobissSystem.OutputType.Light)
 
     @property
     def fans(self):
-        result = [ ]
-        for output in self.outputs:
-            if output['type'] == DobissSystem.OutputType.Fan:
-                result.append(output)
-
-        return result
+        return self.outputs.ofType(DobissSystem.OutputType.Fan)
 
     @property
     def plugs(self):
-        result = [ ]
-        for output in self.outputs:
-            if output['type'] == DobissSystem.OutputType.Plug:
-                result.append(output)
+        return self.outputs.ofType(DobissSystem.OutputType.Plug)
 
-        return result
 
-    def connect(self):
-        """Connect to a Dobiss system.
-           Keeps trying to connect until it is successfully connected.
+    def setCapture(self, capture):
+        """Record all sent and received chunks with capture (an object with sent(data) and received(data),
+           like capture.CaptureWriter), or stop recording with None. The previous capture is closed.
+        """
+        if self.capture is not None:
+            self.capture.close()
+        self.capture = capture
+
+    def statistics(self):
+        """The metrics and connection state, as JSON-serializable data."""
+        return {
+            'host': self.host,
+            'port': self.port,
+            'connected': self.connected,
+            'reconnects': self.backoff.reconnects,
+            'connectFailures': self.backoff.failures,
+            'modules': len(self.modules),
+            'outputs': len(self.outputs),
+            'lastImportTimings': self.lastImportTimings,
+            'lastPollBuffer': self.lastPollStats,
+            **self.parser.stats,
+            **self.metrics.asDict()
+        }
+
+    def missingModules(self):
+        """The available modules whose module, outputs or status response didn't come in
+           (e.g. lost, or the connection dropped during the import).
+        """
+        return [
+            moduleAddr for moduleAddr in self.availableModules
+            if moduleAddr not in self.modules
+            or len(self.outputs.ofModule(moduleAddr)) != self.modules[moduleAddr].outputCount
+            or not self.values.stored(moduleAddr)
+        ]
+
+    def valuesOf(self, moduleAddr):
+        """The live values of a module: a bytearray with one byte per output that is updated in place.
+           It stays the same object as long as the module keeps its outputs, so it can be kept.
         """
+        return self.values.allocate(moduleAddr, self.modules[moduleAddr].outputCount)
+
+    def exportInstallation(self, includeValues = True):
+        """The imported installation (modules and outputs) and optionally the last known values,
+           as JSON-serializable data for caching.
+        """
+        data = {
+            'modules': [
+                {
+                    'address': module.address,
+                    'type': int(module.type),
+                    'isMaster': module.isMaster,
+                    'outputCount': module.outputCount
+                }
+                for moduleAddr, module in sorted(self.modules.items())
+            ],
+            'outputs': [
+                {
+                    'moduleAddress': output.moduleAddress,
+                    'index': output.index,
+                    'name': output.name,
+                    'type': int(output.type),
+                    'groupIndex': output.groupIndex
+                }
+                for output in sorted(self.outputs, key = lambda output: output.key)
+            ]
+        }
+
+        if includeValues:
+            data['values'] = { str(moduleAddr): list(values) for moduleAddr, values in self.values.items() }
+
+        return data
+
+    def loadInstallation(self, data):
+        """Load an installation exported with exportInstallation, replacing the current one.
+           Raises KeyError, TypeError or ValueError on invalid data.
+        """
+        modules = { }
+        for module in data['modules']:
+            modules[module['address']] = DobissModule(
+                module['address'], DobissSystem.ModuleType(module['type']), module['isMaster'], module['outputCount'])
+
+        outputs = OutputRegistry()
+        for output in data['outputs']:
+            outputs.add(DobissOutput(
+                output['moduleAddress'], output['index'], output['name'], DobissSystem.OutputType(output['type']), output['groupIndex']))
+
+        values = ValueStore()
+        for moduleAddr, module in modules.items():
+            values.allocate(moduleAddr, module.outputCount)
+            moduleValues = data.get('values', { }).get(str(moduleAddr))
+            if moduleValues is not None:
+                values.update(moduleAddr, bytes(moduleValues))
+
+        self.availableModules = list(modules)
+        self.modules = modules
+        self.outputs = outputs
+        self.values = values
+
+
+    class ModuleType(IntEnum):
+        """The type of module."""
+        Relais = 0x08
+        Dimmer = 0x10
+        V0_10 = 0x18
+
+    class OutputType(IntEnum):
+        """The type of output."""
+        Light = 0x00
+        Plug = 0x01
+        Fan = 0x02
+        Up = 0x03
+        Down = 0x04
+
+    class Action(IntEnum):
+        """The type of action."""
+        TurnOff = 0x00
+        TurnOn = 0x01
+        Toggle = 0x02
+
+
+    def parseInstallation(self, installationData):
+        """Parse the installation response."""
+
+        if(receivedSize(installationData) != 16):
+            print(f"Invalid data received trying to import installation: received {receivedSize(installationData)} bytes instead of 16")
+            return
+
+        # Parse the installation
+        self.availableModules = decodeInstallation(installationData)
+
+        print("Available modules: " + str(self.availableModules))
+
+    def parseModule(self, moduleData):
+        """Parse a module response."""
+
+        if(receivedSize(moduleData) != 16):
+            print(f"Invalid data received trying to import module: received {receivedSize(moduleData)} bytes instead of 16")
+            return
+
+        moduleAddr, isMaster, moduleType = decodeModule(moduleData)
+        moduleType = DobissSystem.ModuleType(moduleType)
+
+        # 12 outputs for relais, 4 for dimmers
+        if moduleType == DobissSystem.ModuleType.Relais:
+            outputCount = 12
+        else:
+            outputCount = 4
+
+        # Cache the module
+        self.modules[moduleAddr] = DobissModule(moduleAddr, moduleType, isMaster, outputCount)
+
+        print(f"Module {moduleAddr} imported: " + str(self.modules[moduleAddr]))
+
+    def parseOutputTable(self, moduleAddr, outputCount, outputsData):
+        """Parse the outputs response of a module into a list of outputs, or None if it is invalid."""
+
+        # <module.outputCount> lines of 32 bytes
+        # Output names of 30 characters; convert byte array to string;
+        # data[30] = icon type (0=light, 1=plug, 2=fan, 3=up, 4=down); data[31] = group index
+        if(receivedSize(outputsData) != 32 * outputCount):
+            print(f"Invalid data received trying to import module: received {receivedSize(outputsData)} bytes instead of {32 * outputCount}")
+            return None
+
+        return [
+            DobissOutput(moduleAddr, outputIndex, outputName, DobissSystem.OutputType(outputType), groupIndex)
+            for outputIndex, (outputName, outputType, groupIndex) in enumerate(decodeOutputs(outputsData))
+        ]
+
+    def parseOutputs(self, moduleAddr, outputCount, outputsData):
+        """Parse the outputs response of a module."""
+        outputs = self.parseOutputTable(moduleAddr, outputCount, outputsData)
+        if outputs is None:
+            return
+
+        # Replace the outputs of the module
+        self.outputs.removeModule(moduleAddr)
+
+        for output in outputs:
+            # Cache the output
+            self.outputs.add(output)
+
+            print(f"Output imported: " + str(output))
+
+    def updateOutputs(self, moduleAddr, outputCount, outputsData):
+        """Update the outputs of a module from its outputs response, only changing the outputs that differ.
+           Returns the (added, removed, changed) outputs. Changed outputs (name or group) are updated in place;
+           an output whose type changed is removed and added again.
+        """
+        added, removed, changed = [ ], [ ], [ ]
+
+        outputs = self.parseOutputTable(moduleAddr, outputCount, outputsData)
+        if outputs is None:
+            return added, removed, changed
+
+        for output in outputs:
+            current = self.outputs.get(moduleAddr, output.index)
+
+            if current is None or current.type != output.type:
+                if current is not None:
+                    removed.append(current)
+                self.outputs.add(output)
+                added.append(output)
+
+            elif current.name != output.name or current.groupIndex != output.groupIndex:
+                changed.append(self.outputs.update(moduleAddr, output.index, name=output.name, groupIndex=output.groupIndex))
+
+        # Outputs beyond the output count
+        for current in self.outputs.ofModule(moduleAddr):
+            if current.index >= outputCount:
+                removed.append(self.outputs.remove(moduleAddr, current.index))
+
+        return added, removed, changed
+
+    def removeModule(self, moduleAddr):
+        """Forget a module, its outputs and its values. Returns its removed outputs."""
+        self.modules.pop(moduleAddr, None)
+        self.values.removeModule(moduleAddr)
+        return self.outputs.removeModule(moduleAddr)
+
+    def parseStatus(self, moduleAddr, outputCount, statusData):
+        """Parse the status response of a module."""
+
+        if(receivedSize(statusData) != 16):
+            print(f"Invalid data received trying to import module: received {receivedSize(statusData)} bytes instead of 16")
+            return
+
+        # Cache the values
+        self.values.allocate(moduleAddr, outputCount)
+        self.values.update(moduleAddr, statusData)
+
+
+class DobissSystem(DobissSystemBase):
+    """Dobiss system using a blocking socket."""
+
+    def __init__(self, host, port, timeout = TIMEOUT):
+
+        super().__init__(host, port)
+
+        self.timeout = timeout
+        self.socket = None
+        self.recvBuffer = RecvBuffer()
+        self.parser = ResponseParser(self.recvBuffer)
+        self.backoff = ReconnectBackoff()
+
+    def connect(self):
+        """Connect to a Dobiss system, with a fresh socket."""
         success = False
 
+        # A closed socket can't be reused
+        self.disconnect()
+
         try:
             print(f"Connecting to Dobiss system at IP {self.host} and port {self.port}")
-            self.socket.connect((self.host, self.port))
+            self.socket = socket.create_connection((self.host, self.port), self.timeout)
+            enableKeepAlive(self.socket)
             self._connected = True
-            self.socket.settimeout(None)
+            self.backoff.connected()
             success = True
 
-        except socket.error as e:
+        except OSError as e:
             self._connected = False
+            self.backoff.failed()
             success = False
             print(f"Dobiss socket error while trying to connect: {str(e)}")
 
@@ -94,282 +926,857 @@ class DobissSystem:
     def disconnect(self):
         """Disconnect from the connected Dobiss system.
         """
-        self.socket.close()
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+        # Whatever was still buffered belongs to the old connection
+        self.recvBuffer.clear()
         self._connected = False
+        self.backoff.lost()
 
 
     def sendData(self, data):
         """Send data to a Dobiss system.
-           Keeps trying to send the data until it is successful, reconnecting with the system if necessary.
+           Keeps trying to send the data until it is successful, reconnecting with the system
+           (with backoff) if necessary, for at most MAX_NUM_RETRIES tries.
         """
-        dataSent = False
-        retry = True
         numRetries = 0
-        
-        while retry:
-            try:
-                self.socket.sendall(data)
-                dataSent = True
-                retry = False
-
-            except socket.error as e:
-                if e.errno == socket.errno.ENOTCONN:
-                    self._connected = False
-                    numRetries += 1
-                    print(f"Dobiss socket error {str(e)}. Connecting (try {numRetries} of {MAX_NUM_RETRIES})...")
-                    self.connect()
-
-                    if numRetries >= MAX_NUM_RETRIES:
-                        retry = False
-
-                else:
-                    print("Dobiss socket error " + str(e) + "!")
-                    retry = False
-
-        return dataSent
 
+        while numRetries < MAX_NUM_RETRIES:
+            if not self._connected:
+                numRetries += 1
+                time.sleep(self.backoff.waitTime)
+                print(f"Dobiss not connected. Connecting (try {numRetries} of {MAX_NUM_RETRIES})...")
+                if not self.connect():
+                    self.metrics.retries += 1
+                    continue
 
-    def receiveResponse(self, sentDataSize, responseSize):
-        """Receive response"""
+            try:
+                self.socket.sendall(data)
+                self.metrics.bytesSent += len(data)
+                if self.capture is not None:
+                    self.capture.sent(data)
+                return True
+
+            except OSError as e:
+                print("Dobiss socket error " + str(e) + "!")
+                self.disconnect()
+                self.metrics.retries += 1
+                numRetries += 1
+
+        self.metrics.failures += 1
+        return False
+
+
+    def receiveResponse(self, data, responseSize, later = ()):
+        """Receive the response to the sent data; later are the requests sent after it.
+           Returns a view into the receive buffer, which is only valid until the next response is received.
+           Returns None if the response was lost or the connection failed. With parser.onReport set,
+           data that could still have been reports is taken as responses on a timeout.
+        """
 
         # Receive until we have enough data
         # The data consists of the sent data (padded to 32 bytes) and then the response data (padded to 32 bytes)
-        sentDataPaddingSize = (32 - (sentDataSize % 32)) % 32
-        responsePaddingSize = (32 - (responseSize % 32)) % 32
-        totalSize = sentDataSize + sentDataPaddingSize + responseSize + responsePaddingSize
+        totalSize = paddedSize(len(data)) + paddedSize(responseSize)
 
-        numRetries = 0
-        
-        while (len(self.recvBuffer) < totalSize) and (numRetries < MAX_NUM_RETRIES):
-            try:
-                newData = [ ]
-                newData = self.socket.recv(RECV_SIZE)
-                
-                if len(newData) > 0:
-                    self.recvBuffer += newData
-                    #print(f"Received from socket. Buffer is now length {len(self.recvBuffer)}")
-            
-            except socket.error as e:
-                print(f"Dobiss socket error while receiving data: {str(e)}")
-                return [ ]
+        # The whole response has to arrive before the deadline
+        deadline = time.monotonic() + self.timeout
 
-        # We first receive the original packet back
-        # TODO Actually check the content
-        #original = self.recvBuffer[:sentDataSize]
-        
-        # The actual response data
-        responseData = bytearray()
-        if responseSize > 0:
-            start = sentDataSize + sentDataPaddingSize
-            end = start + responseSize
-            responseData = self.recvBuffer[start:end]
+        final = False
+        while True:
+            result, response = self.parser.parse(data, responseSize, later, final)
+            if result == ResponseParser.Result.Complete:
+                return response
+            if result == ResponseParser.Result.Lost:
+                print("Dobiss response lost, continuing with the next response")
+                return None
 
-        # Remove the response from the buffer        
-        self.recvBuffer = self.recvBuffer[totalSize:]
-        
-        return responseData
+            try:
+                if not self._connected:
+                    raise ConnectionError("Not connected")
+                if final:
+                    raise ConnectionError("Timed out")
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise socket.timeout("Timed out")
+                self.socket.settimeout(remaining)
+
+                numBytes = self.recvBuffer.recvInto(self.socket, max(RECV_SIZE, totalSize - len(self.recvBuffer)))
+                if numBytes == 0:
+                    raise ConnectionError("Connection closed by the controller")
+                self.metrics.bytesReceived += numBytes
+                if self.capture is not None:
+                    self.capture.received(self.recvBuffer.peek()[-numBytes:])
+
+            except socket.timeout:
+                # Parse once more without waiting for what could still turn out to be reports
+                final = True
+
+            except OSError as e:
+                print(f"Dobiss socket error while receiving data: {str(e)}")
+                self.disconnect()
+                self.metrics.failures += 1
+                return None
 
 
-    def importFullInstallation(self):
-        """Import the installation, all modules, their outputs and their status."""
+    def importFullInstallation(self, pipelined = False):
+        """Import the installation, all modules, their outputs and their status.
+           When pipelined, the module, output and status queries are each sent as one burst.
+           The duration of every phase is kept in lastImportTimings.
+        """
+        timings = { }
+        start = time.perf_counter()
 
         # Import installation
         self.importInstallation()
+        timings['installation'] = time.perf_counter() - start
 
         # Import modules
-        for moduleAddr in self.availableModules:
-            self.importModule(moduleAddr)
+        if pipelined:
+            for moduleData in self.requestBurst([ (moduleRequest(moduleAddr), 16) for moduleAddr in self.availableModules ]):
+                self.parseModule(moduleData)
+        else:
+            for moduleAddr in self.availableModules:
+                self.importModule(moduleAddr)
+        timings['modules'] = time.perf_counter() - start - sum(timings.values())
+
+        # Outputs
+        modules = list(self.modules.values())
+        if pipelined:
+            responses = self.requestBurst([ (outputsRequest(module.address, module.type, module.outputCount), 32 * module.outputCount) for module in modules ])
+            for module, outputsData in zip(modules, responses):
+                self.parseOutputs(module.address, module.outputCount, outputsData)
+        else:
+            for module in modules:
+                self.importOutputs(module.address, module.type, module.outputCount)
+        timings['outputs'] = time.perf_counter() - start - sum(timings.values())
 
-        # Outputs and their current value
-        for moduleAddr, module in self.modules.items():
-            self.importOutputs(module['address'], module['type'], module['outputCount'])
-            self.requestStatus(module['address'], module['type'], module['outputCount'])
+        # Their current value
+        self.requestAllStatus(pipelined)
+        timings['status'] = time.perf_counter() - start - sum(timings.values())
+
+        timings['total'] = time.perf_counter() - start
+        self.lastImportTimings = timings
+        print(f"Installation imported: " + ", ".join(f"{phase} {duration * 1000:.1f} ms" for phase, duration in timings.items()))
 
 
     def importInstallation(self):
         """Import the installation."""
-        data = bytearray.fromhex("AF 0B 00 00 30 00 10 01 10 FF FF FF FF FF FF AF")
-        self.sendData(data)
+        installationData = self.request(installationRequest(), 16)
+        self.parseInstallation(installationData)
+
+    def importModule(self, moduleAddr):
+        """Import a module."""
+        moduleData = self.request(moduleRequest(moduleAddr), 16)
+        self.parseModule(moduleData)
+
+    def importOutputs(self, moduleAddr, moduleType, outputCount):
+        """Import the outputs of a module."""
+        outputsData = self.request(outputsRequest(moduleAddr, moduleType, outputCount), 32 * outputCount)
+        self.parseOutputs(moduleAddr, outputCount, outputsData)
+
+
+    def requestStatus(self, moduleAddr, moduleType, outputCount):
+        """Request the status of all outputs of a module."""
+        statusData = self.request(statusRequest(moduleAddr, moduleType), 16)
+        self.parseStatus(moduleAddr, outputCount, statusData)
 
-        installationData = self.receiveResponse(len(data), 16)
 
-        if(len(installationData) != 16):
-            print(f"Invalid data received trying to import installation: received {len(installationData)} bytes instead of 16")
+    def request(self, data, responseSize):
+        """Send a frame and receive its response, or None if it was lost or the connection failed."""
+        return next(self.requestBurst([ (data, responseSize) ]), None)
+
+    def requestBurst(self, requests):
+        """Send several frames in one burst and receive their responses in order.
+           requests is a list of (frame, responseSize). This generates the responses one by one,
+           since each is a view into the receive buffer that is only valid until the next one is received.
+           A lost response is None. Stops when the connection fails, so there can be
+           fewer responses than requests.
+        """
+        if not requests or not self.sendData(b''.join(data for data, responseSize in requests)):
             return
 
-        # Parse the installation
-        self.availableModules = [ ]
+        sentAt = time.perf_counter()
+        self.metrics.framesSent += len(requests)
 
-        # First 11 bytes (bits 0-81) contain whether or not there is a module with the specific address (1-82)
-        for i in range(0, 82):
-            byteNum = int(i / 8)
-            bitNum = int(i % 8)
-            hasModule = (installationData[byteNum] >> bitNum) & 1
-            if hasModule:
-                channelAddr = i + 1
-                self.availableModules.append(channelAddr)
-        
-        print("Available modules: " + str(self.availableModules))
+        for index, (data, responseSize) in enumerate(requests):
+            response = self.receiveResponse(data, responseSize, requests[index + 1:])
+            if response is None:
+                if not self._connected:
+                    break
+                yield None
+                continue
 
+            self.metrics.framesReceived += 1
+            self.metrics.recordFrame(frameType(data), time.perf_counter() - sentAt)
+            yield response
 
-    class ModuleType(IntEnum):
-        """The type of module."""
-        Relais = 0x08
-        Dimmer = 0x10
-        V0_10 = 0x18
+    def requestAllStatus(self, pipelined = False):
+        """Request the status of all outputs of all modules.
+           When pipelined, all status requests are sent in one burst instead of one round trip per module.
+        """
 
-    def importModule(self, moduleAddr):
-        """Import a module."""
+        self.recvBuffer.resetStats()
+        start = time.perf_counter()
 
-        # Import the module
-        #data = bytearray.fromhex("AF 10 FF " + chr(moduleAddr).encode('hex') + " 00 00 10 01 10 FF FF FF FF FF FF AF")
-        data = bytearray.fromhex("AF 10 FF " + f"{moduleAddr:02x}" + " 00 00 10 01 10 FF FF FF FF FF FF AF")
-        self.sendData(data)
+        if not pipelined:
+            for moduleAddr, module in self.modules.items():
+                self.requestStatus(module.address, module.type, module.outputCount)
 
-        moduleData = self.receiveResponse(len(data), 16)
+        else:
+            modules = list(self.modules.values())
+            responses = self.requestBurst([ (statusRequest(module.address, module.type), 16) for module in modules ])
 
-        if(len(moduleData) != 16):
-            print(f"Invalid data received trying to import module: received {len(moduleData)} bytes instead of 16")
-            return
+            for module, statusData in zip(modules, responses):
+                self.parseStatus(module.address, module.outputCount, statusData)
 
-        #moduleAddr = ord(moduleData[0])
-        #moduleType = ord(moduleData[14])
-        #master = ord(moduleData[2])
-        moduleAddr = moduleData[0]
-        moduleType = DobissSystem.ModuleType(moduleData[14])
-        master = moduleData[2]
-        masterLSB = master&1
-        isMaster = (masterLSB == 1)
+        self.lastPollStats = self.recvBuffer.stats
+        self.metrics.recordPoll(time.perf_counter() - start)
 
-        # 12 outputs for relais, 4 for dimmers
-        if moduleType == DobissSystem.ModuleType.Relais:
-            outputCount = 12
+
+    def setOn(self, moduleAddr, outputIndex, brightness = 100):
+        """Switch an output on."""
+
+        action = DobissSystem.Action.TurnOn
+        self.sendAction(moduleAddr, outputIndex, action, brightness)
+
+    def setOff(self, moduleAddr, outputIndex):
+        """Switch an output off."""
+
+        action = DobissSystem.Action.TurnOff
+        self.sendAction(moduleAddr, outputIndex, action)
+
+    def toggle(self, moduleAddr, outputIndex):
+        """Toggle an output."""
+
+        action = DobissSystem.Action.Toggle
+        self.sendAction(moduleAddr, outputIndex, action)
+
+    def sendAction(self, moduleAddr, outputIndex, action, value = 100, delayOn = 0xFF, delayOff = 0xFF, softDim = 0xFF, red = 0xFF):
+        """Generic method to send an action to an output.
+           Returns True if both the header and the data were echoed.
+        """
+
+        # Send the request header
+        # Note: no additional data is sent back
+        headerEcho = self.request(actionHeader(moduleAddr), 0)
+
+        # Send the request data
+        # Note: no additional data is sent back
+        dataEcho = self.request(actionData(moduleAddr, outputIndex, action, value, delayOn, delayOff, softDim, red), 0)
+
+        return headerEcho is not None and dataEcho is not None
+
+    def sendActions(self, actions):
+        """Send several actions in one burst.
+           actions is a list of argument tuples for sendAction: (moduleAddr, outputIndex, action[, value, ...]).
+           Returns True if all echoes were received.
+        """
+        requests = [ request for args in actions for request in actionRequests(*args) ]
+        return allReceived(list(self.requestBurst(requests)), requests)
+
+
+class AsyncDobissSystem(DobissSystemBase):
+    """Dobiss system using asyncio streams, for use on an event loop.
+       Every connect and receive has a deadline, so a silent controller can't block the loop.
+
+       All I/O is done by a single worker task, fed by a priority queue of bursts: callers get a
+       future for their responses, and queued actions go before queued polls and imports.
+       The worker also owns the connection: it connects when it has something to send, and close
+       stops it before disconnecting.
+       When listening, the worker also reads while it is idle, so status reports the controller sends
+       unsolicited (e.g. after a wall switch was pressed) are parsed right away instead of on the next poll.
+    """
+
+    class Priority(IntEnum):
+        """The priority of a request: lower goes first."""
+        Action = 0
+        Verify = 1
+        Poll = 2
+        Import = 3
+
+    def __init__(self, host, port, timeout = TIMEOUT, actionWindow = ACTION_WINDOW, listen = False):
+
+        super().__init__(host, port)
+
+        self.timeout = timeout
+        self.listen = listen
+        self._reader = None
+        self._writer = None
+        self.recvBuffer = RecvBuffer()
+        self.parser = ResponseParser(self.recvBuffer)
+        self.backoff = ReconnectBackoff()
+
+        # Only look for reports when listening: telling a report from an echo can mean waiting for more data
+        if listen:
+            self.parser.onReport = self.parseReport
+
+        # Called with the module address after a module reported its status unsolicited
+        self.onStatusReported = None
+        self.lastReport = None
+
+        # Modules that reported after the response to their last status request was received:
+        # that response is older than their values once it is parsed at the end of its burst
+        self._reportedSinceStatus = set()
+
+        # The queue of (priority, sequence number, requests, onResponse, future) of the I/O worker
+        self._queue = asyncio.PriorityQueue()
+        self._sequence = 0
+        self._worker = None
+        self._closed = False
+
+        # Actions waiting to be sent in the next burst, as (requests, future)
+        self.actionWindow = actionWindow
+        self._pendingActions = [ ]
+
+    async def _connect(self):
+        """Connect to a Dobiss system, with a fresh connection. Only used by the I/O worker."""
+        success = False
+
+        await self._disconnect()
+
+        try:
+            print(f"Connecting to Dobiss system at IP {self.host} and port {self.port}")
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self.timeout)
+            enableKeepAlive(self._writer.get_extra_info('socket'))
+            self._connected = True
+            self.backoff.connected()
+            success = True
+
+        except (OSError, asyncio.TimeoutError) as e:
+            self._connected = False
+            self.backoff.failed()
+            success = False
+            print(f"Dobiss socket error while trying to connect: {repr(e)}")
+
+        return success
+
+    async def close(self):
+        """Stop the I/O worker, disconnect and stop recording.
+           Queued bursts and pending actions fail with a ConnectionError, and so does every later request.
+        """
+        self._closed = True
+
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+        while not self._queue.empty():
+            priority, sequence, requests, onResponse, future = self._queue.get_nowait()
+            AsyncDobissSystem._fail(future)
+
+        pendingActions = self._pendingActions
+        self._pendingActions = [ ]
+        for actionRequests, future in pendingActions:
+            AsyncDobissSystem._fail(future)
+
+        await self._disconnect()
+        self.setCapture(None)
+
+    @staticmethod
+    def _fail(future):
+        """Fail the future of a request because the system was closed."""
+        if not future.done():
+            future.set_exception(ConnectionError("Dobiss system is closed"))
+
+    async def _disconnect(self):
+        """Disconnect from the connected Dobiss system. Only used by the I/O worker, and by close once it stopped."""
+        writer = self._writer
+        self._reader = None
+        self._writer = None
+        self._connected = False
+        self.backoff.lost()
+
+        # Whatever was still buffered belongs to the old connection
+        self.recvBuffer.clear()
+
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    async def sendData(self, data):
+        """Send data to a Dobiss system, connecting first if necessary.
+           While backing off after failed connects this fails right away instead of waiting,
+           so requests don't pile up behind a controller that is down.
+        """
+        for attempt in range(2):
+            if not self._connected:
+                if self.backoff.waitTime > 0:
+                    return False
+
+                print(f"Dobiss not connected. Connecting (after {self.backoff.failures} failed tries)...")
+                if not await self._connect():
+                    return False
+
+            try:
+                self._writer.write(data)
+                await asyncio.wait_for(self._writer.drain(), self.timeout)
+                self.metrics.bytesSent += len(data)
+                if self.capture is not None:
+                    self.capture.sent(data)
+                return True
+
+            except (OSError, asyncio.TimeoutError) as e:
+                # Try once more on a fresh connection
+                print(f"Dobiss socket error while sending data: {repr(e)}")
+                await self._disconnect()
+                self.metrics.retries += 1
+
+        self.metrics.failures += 1
+        return False
+
+    async def receiveResponse(self, data, responseSize, later = ()):
+        """Receive the echo of the sent data followed by the response, within the timeout;
+           later are the requests sent after it.
+           Returns a view into the receive buffer, which is only valid until the next data is received.
+           Returns None if the response was lost or there is no connection. On a timeout, data that
+           could still have been reports is taken as responses; if that doesn't make up the response
+           either, or on a closed connection, the connection is dropped, since the controller is no
+           longer responding.
+        """
+        if not self._connected:
+            return None
+
+        # The data consists of the sent data (padded to 32 bytes) and then the response data (padded to 32 bytes)
+        totalSize = paddedSize(len(data)) + paddedSize(responseSize)
+
+        # The whole response has to arrive before the deadline
+        deadline = time.monotonic() + self.timeout
+
+        final = False
+        while True:
+            result, response = self.parser.parse(data, responseSize, later, final)
+            if result == ResponseParser.Result.Complete:
+                return response
+            if result == ResponseParser.Result.Lost:
+                print("Dobiss response lost, continuing with the next response")
+                return None
+
+            try:
+                if final:
+                    raise ConnectionError("Timed out")
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+
+                chunk = await asyncio.wait_for(self._reader.read(max(RECV_SIZE, totalSize - len(self.recvBuffer))), remaining)
+                if not chunk:
+                    raise ConnectionError("Connection closed by the controller")
+
+            except asyncio.TimeoutError:
+                # Parse once more without waiting for what could still turn out to be reports
+                final = True
+                continue
+
+            except OSError as e:
+                print(f"Dobiss socket error while receiving data: {repr(e)}")
+                await self._disconnect()
+                self.metrics.failures += 1
+                return None
+
+            self.recvBuffer.feed(chunk)
+            self.metrics.bytesReceived += len(chunk)
+            if self.capture is not None:
+                self.capture.received(chunk)
+
+    async def request(self, data, responseSize, priority = Priority.Import):
+        """Send a frame and receive its response as one exchange, or None if it was lost or the connection failed."""
+        responses = await self.requestBurst([ (data, responseSize) ], priority)
+        return responses[0] if responses else None
+
+    async def requestBurst(self, requests, priority = Priority.Poll, onResponse = None):
+        """Send several frames in bursts and receive their responses in order.
+           requests is a list of (frame, responseSize); returns the list of responses.
+           Except for actions, the requests are queued in bursts of at most MAX_BURST_SIZE.
+           A lost response is None. Stops when the connection fails, so the result
+           can be shorter than requests.
+           The responses are copied out of the receive buffer, unless onResponse is given: it is
+           called by the I/O worker with the index of the request and the response while that is
+           still a view into the buffer, and a received response is True in the result.
+        """
+        if not requests:
+            return [ ]
+
+        # The header and payload of an action must not be separated
+        if priority == AsyncDobissSystem.Priority.Action:
+            bursts = [ requests ]
         else:
-            outputCount = 4
+            bursts = [ requests[start:start + MAX_BURST_SIZE] for start in range(0, len(requests), MAX_BURST_SIZE) ]
+
+        futures = [ ]
+        for start, burst in zip(range(0, len(requests), MAX_BURST_SIZE), bursts):
+            burstOnResponse = None
+            if onResponse is not None:
+                burstOnResponse = lambda index, response, start = start: onResponse(start + index, response)
+            futures.append(self._submit(burst, priority, burstOnResponse))
+
+        responses = [ ]
+        for burst, future in zip(bursts, futures):
+            burstResponses = await future
+            responses += burstResponses
+            if len(burstResponses) != len(burst):
+                break
+
+        return responses
+
+    def _submit(self, requests, priority, onResponse = None):
+        """Queue a burst for the I/O worker and return the future of its responses."""
+        if self._closed:
+            raise ConnectionError("Dobiss system is closed")
+
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.ensure_future(self._run())
+
+        future = asyncio.get_running_loop().create_future()
+        self._sequence += 1
+        self._queue.put_nowait((priority, self._sequence, requests, onResponse, future))
+        return future
+
+    async def _run(self):
+        """The I/O worker: the only one sending to and receiving from the controller."""
+        while True:
+            priority, sequence, requests, onResponse, future = await self._nextBurst()
+            if future.done():
+                continue
 
-        # Cache the module
-        self.modules[moduleAddr] = {
-            'address': moduleAddr,
-            'type': moduleType,
-            'isMaster': isMaster,
-            'outputCount': outputCount
-        }
+            try:
+                responses = await self._exchange(requests, onResponse)
+            except asyncio.CancelledError:
+                # Only cancelled by close
+                AsyncDobissSystem._fail(future)
+                raise
+            except Exception as e:
+                future.set_exception(e)
+                continue
+
+            if not future.done():
+                future.set_result(responses)
+
+    async def _nextBurst(self):
+        """Wait for the next queued burst. When listening, status reports are received in the meantime."""
+        if not self.listen:
+            return await self._queue.get()
+
+        nextBurst = asyncio.ensure_future(self._queue.get())
+        received = None
+        try:
+            while self._connected and not nextBurst.done():
+                reader = self._reader
+                received = asyncio.ensure_future(reader.read(RECV_SIZE))
+                await asyncio.wait({ nextBurst, received }, return_when = asyncio.FIRST_COMPLETED)
+
+                if not received.done():
+                    # A burst is queued: the data that is on its way stays in the reader
+                    received.cancel()
+                    await asyncio.wait({ received })
+                if received.cancelled() or reader is not self._reader:
+                    continue
+
+                try:
+                    chunk = received.result()
+                    if not chunk:
+                        raise ConnectionError("Connection closed by the controller")
+                except OSError as e:
+                    print(f"Dobiss socket error while listening: {repr(e)}")
+                    await self._disconnect()
+                    break
+
+                self.recvBuffer.feed(chunk)
+                self.metrics.bytesReceived += len(chunk)
+                if self.capture is not None:
+                    self.capture.received(chunk)
+                self.parser.takeReports()
+
+            return await nextBurst
+
+        finally:
+            nextBurst.cancel()
+            if received is not None:
+                received.cancel()
+
+    async def _exchange(self, requests, onResponse = None):
+        """Send a burst and receive its responses. Only used by the I/O worker."""
+        responses = [ ]
+
+        if not await self.sendData(b''.join(data for data, responseSize in requests)):
+            return responses
+
+        sentAt = time.perf_counter()
+        self.metrics.framesSent += len(requests)
+
+        for index, (data, responseSize) in enumerate(requests):
+            response = await self.receiveResponse(data, responseSize, requests[index + 1:])
+            if response is None:
+                if not self._connected:
+                    break
+                responses.append(None)
+                continue
+
+            kind = frameType(data)
+            self.metrics.framesReceived += 1
+            self.metrics.recordFrame(kind, time.perf_counter() - sentAt)
+
+            if self.listen and kind == 'status':
+                # Reports received after this are newer
+                self._reportedSinceStatus.discard(data[3])
+
+            if onResponse is None:
+                # The responses of a burst are kept until the burst is done
+                responses.append(bytes(response))
+            else:
+                onResponse(index, response)
+                responses.append(True)
 
-        print(f"Module {moduleAddr} imported: " + str(self.modules[moduleAddr]))
+        return responses
 
-    class OutputType(IntEnum):
-        """The type of output."""
-        Light = 0x00
-        Plug = 0x01
-        Fan = 0x02
-        Up = 0x03
-        Down = 0x04
 
-    def importOutputs(self, moduleAddr, moduleType, outputCount):
-        """Import the outputs of a module."""
+    async def importFullInstallation(self, pipelined = False, onModulesImported = None):
+        """Import the installation, all modules, their outputs and their status.
+           When pipelined, the module queries are sent as one burst, and the output and status queries
+           in bursts of MAX_BURST_SIZE modules. onModulesImported is called with the addresses of the
+           modules whose outputs and status were imported after every burst (or module), so their
+           outputs can be used before the whole installation is imported.
+           The duration of every phase is kept in lastImportTimings.
+        """
+        timings = { }
+        start = time.perf_counter()
 
-        # Import the module
-        #data = bytearray.fromhex("AF 10 " + chr(moduleType).encode('hex') +  + chr(moduleAddr).encode('hex') + " 01 00 20 " + chr(outputCount).encode('hex') + " 20 FF FF FF FF FF FF AF")
-        data = bytearray.fromhex("AF 10 " + f"{moduleType.value:02x}" + f"{moduleAddr:02x}" + " 01 00 20 " + f"{outputCount:02x}" + " 20 FF FF FF FF FF FF AF")
-        self.sendData(data)
+        # Import installation
+        await self.importInstallation()
+        timings['installation'] = time.perf_counter() - start
 
-        # <module.outputCount> lines of 32 bytes
-        # Output names of 30 characters; convert byte array to string;
-        # data[30] = icon type (0=light, 1=plug, 2=fan, 3=up, 4=down); data[31] = group index
-        outputsData = self.receiveResponse(len(data), 32 * outputCount)
+        # Import modules
+        if pipelined:
+            for moduleData in await self.requestBurst([ (moduleRequest(moduleAddr), 16) for moduleAddr in self.availableModules ], AsyncDobissSystem.Priority.Import):
+                self.parseModule(moduleData)
+        else:
+            for moduleAddr in self.availableModules:
+                await self.importModule(moduleAddr)
+        timings['modules'] = time.perf_counter() - start - sum(timings.values())
+
+        # Outputs and their current value, module by module or burst by burst
+        modules = list(self.modules.values())
+        timings['outputs'] = 0
+        timings['status'] = 0
+
+        burstSize = MAX_BURST_SIZE if pipelined else 1
+        for first in range(0, len(modules), burstSize):
+            burst = modules[first:first + burstSize]
+
+            phaseStart = time.perf_counter()
+            responses = await self.requestBurst([ (outputsRequest(module.address, module.type, module.outputCount), 32 * module.outputCount) for module in burst ], AsyncDobissSystem.Priority.Import)
+            for module, outputsData in zip(burst, responses):
+                self.parseOutputs(module.address, module.outputCount, outputsData)
+            timings['outputs'] += time.perf_counter() - phaseStart
+
+            phaseStart = time.perf_counter()
+            responses = await self.requestBurst([ (statusRequest(module.address, module.type), 16) for module in burst ], AsyncDobissSystem.Priority.Import)
+            for module, statusData in zip(burst, responses):
+                self.parseStatus(module.address, module.outputCount, statusData)
+            timings['status'] += time.perf_counter() - phaseStart
+
+            if onModulesImported is not None:
+                onModulesImported([ module.address for module in burst ])
+
+        timings['total'] = time.perf_counter() - start
+        self.lastImportTimings = timings
+        print(f"Installation imported: " + ", ".join(f"{phase} {duration * 1000:.1f} ms" for phase, duration in timings.items()))
+
+    async def reimportInstallation(self):
+        """Import the installation again, only changing what differs from the current one.
+           All module types and output tables are queried (the only way to notice a renamed output),
+           but modules and outputs that didn't change are kept as they are, and only the status of
+           added modules, modules whose type changed and modules whose status never came in is requested.
+           Returns a dict with the added, removed and changed modules and outputs, or None if the
+           installation couldn't be queried.
+        """
+        installationData = await self.request(installationRequest(), 16, AsyncDobissSystem.Priority.Import)
+        if receivedSize(installationData) != 16:
+            return None
+        self.parseInstallation(installationData)
+
+        diff = { 'modulesAdded': [ ], 'modulesRemoved': [ ], 'modulesChanged': [ ], 'added': [ ], 'removed': [ ], 'changed': [ ] }
+
+        # Modules that are gone
+        for moduleAddr in list(self.modules):
+            if moduleAddr not in self.availableModules:
+                diff['removed'] += self.removeModule(moduleAddr)
+                diff['modulesRemoved'].append(moduleAddr)
+
+        # Modules that are new or whose type changed
+        moduleTypes = { moduleAddr: module.type for moduleAddr, module in self.modules.items() }
+        for moduleData in await self.requestBurst([ (moduleRequest(moduleAddr), 16) for moduleAddr in self.availableModules ], AsyncDobissSystem.Priority.Import):
+            self.parseModule(moduleData)
+
+        for moduleAddr, module in self.modules.items():
+            if moduleAddr not in moduleTypes:
+                diff['modulesAdded'].append(moduleAddr)
+            elif module.type != moduleTypes[moduleAddr]:
+                # Its outputs and values are imported again
+                diff['removed'] += self.outputs.removeModule(moduleAddr)
+                self.values.removeModule(moduleAddr)
+                diff['modulesChanged'].append(moduleAddr)
+
+        # Outputs that are new, renamed or gone
+        modules = list(self.modules.values())
+        responses = await self.requestBurst([ (outputsRequest(module.address, module.type, module.outputCount), 32 * module.outputCount) for module in modules ], AsyncDobissSystem.Priority.Import)
+        for module, outputsData in zip(modules, responses):
+            added, removed, changed = self.updateOutputs(module.address, module.outputCount, outputsData)
+            diff['added'] += added
+            diff['removed'] += removed
+            diff['changed'] += changed
+
+        # The values of the new modules, and of the modules whose status didn't come in before
+        await self.requestModulesStatus([ moduleAddr for moduleAddr in self.modules if not self.values.stored(moduleAddr) ], AsyncDobissSystem.Priority.Import)
+
+        print(f"Installation re-imported: {len(diff['added'])} outputs added, {len(diff['removed'])} removed, {len(diff['changed'])} changed")
+        return diff
+
+    async def importInstallation(self):
+        """Import the installation."""
+        installationData = await self.request(installationRequest(), 16)
+        self.parseInstallation(installationData)
+
+    async def importModule(self, moduleAddr):
+        """Import a module."""
+        moduleData = await self.request(moduleRequest(moduleAddr), 16)
+        self.parseModule(moduleData)
+
+    async def importOutputs(self, moduleAddr, moduleType, outputCount):
+        """Import the outputs of a module."""
+        outputsData = await self.request(outputsRequest(moduleAddr, moduleType, outputCount), 32 * outputCount)
+        self.parseOutputs(moduleAddr, outputCount, outputsData)
 
-        if(len(outputsData) != 32 * outputCount):
-            print(f"Invalid data received trying to import module: received {len(outputsData)} bytes instead of {32 * outputCount}")
+    def parseReport(self, frame, statusData):
+        """Parse an unsolicited status report of a module."""
+        module = self.modules.get(frame[3])
+        if module is None:
             return
 
-        for outputIndex in range(0, outputCount):
-            line = outputsData[outputIndex * 32 : (outputIndex + 1) * 32]
-            outputName = line[0:30].strip().decode()
-            outputType = DobissSystem.OutputType(line[30])
-            groupIndex = line[31]
+        self.values.allocate(module.address, module.outputCount)
+        self.values.update(module.address, statusData)
+        self._reportedSinceStatus.add(module.address)
+        self.lastReport = time.monotonic()
 
-            # Cache the output
-            self.outputs.append({
-                'moduleAddress': moduleAddr,
-                'index': outputIndex,
-                'name': outputName,
-                'type': outputType,
-                'groupIndex': groupIndex
-            })
+        if self.onStatusReported is not None:
+            self.onStatusReported(module.address)
 
-            print(f"Output imported: " + str(self.outputs[len(self.outputs) - 1]))
+    def parseStatus(self, moduleAddr, outputCount, statusData):
+        """Parse the status response of a module, unless the module reported a newer status since."""
+        if moduleAddr in self._reportedSinceStatus:
+            return
 
+        super().parseStatus(moduleAddr, outputCount, statusData)
 
-    def requestStatus(self, moduleAddr, moduleType, outputCount):
+    async def requestStatus(self, moduleAddr, moduleType, outputCount, priority = Priority.Poll):
         """Request the status of all outputs of a module."""
+        statusData = await self.request(statusRequest(moduleAddr, moduleType), 16, priority)
+        self.parseStatus(moduleAddr, outputCount, statusData)
 
-        # Request the status
-        data = bytearray.fromhex("AF 01 " + f"{moduleType.value:02x}" + f"{moduleAddr:02x}" + " 00 00 00 01 00 FF FF FF FF FF FF AF")
-        self.sendData(data)
-
-        statusData = self.receiveResponse(len(data), 16)
+    async def requestAllStatus(self, pipelined = False, priority = Priority.Poll):
+        """Request the status of all outputs of all modules.
+           When pipelined, all status requests are sent in one burst instead of one round trip per module.
+        """
 
-        if(len(statusData) != 16):
-            print(f"Invalid data received trying to import module: received {len(statusData)} bytes instead of 16")
+        if not pipelined:
+            start = time.perf_counter()
+            for moduleAddr, module in self.modules.items():
+                await self.requestStatus(module.address, module.type, module.outputCount, priority)
+            self.metrics.recordPoll(time.perf_counter() - start)
             return
 
-        if not moduleAddr in self.values:
-            self.values[moduleAddr] = [ ]
+        await self.requestModulesStatus(list(self.modules), priority)
 
-        for outputIndex in range(0, outputCount):
-            value = statusData[outputIndex]
 
-            # Cache the value
-            if len(self.values[moduleAddr]) <= outputIndex:
-                self.values[moduleAddr].append(value)
-            else:
-                self.values[moduleAddr][outputIndex] = value
+    async def requestModulesStatus(self, moduleAddrs, priority = Priority.Poll):
+        """Request the status of the outputs of some modules, in one burst.
+           The statuses are parsed by the I/O worker straight from the receive buffer.
+        """
+        self.recvBuffer.resetStats()
+        start = time.perf_counter()
 
+        modules = [ self.modules[moduleAddr] for moduleAddr in moduleAddrs if moduleAddr in self.modules ]
 
-    def requestAllStatus(self):
-        """Request the status of all outputs of all modules."""
+        def onStatus(index, statusData):
+            self.parseStatus(modules[index].address, modules[index].outputCount, statusData)
 
-        for moduleAddr, module in self.modules.items():
-            self.requestStatus(module['address'], module['type'], module['outputCount'])
+        await self.requestBurst([ (statusRequest(module.address, module.type), 16) for module in modules ], priority, onStatus)
 
+        self.lastPollStats = self.recvBuffer.stats
+        self.metrics.recordPoll(time.perf_counter() - start)
 
-    class Action(IntEnum):
-        """The type of action."""
-        TurnOff = 0x00
-        TurnOn = 0x01
-        Toggle = 0x02
 
-    def setOn(self, moduleAddr, outputIndex, brightness = 100):
+    async def setOn(self, moduleAddr, outputIndex, brightness = 100):
         """Switch an output on."""
+        return await self.sendAction(moduleAddr, outputIndex, DobissSystem.Action.TurnOn, brightness)
 
-        action = DobissSystem.Action.TurnOn
-        self.sendAction(moduleAddr, outputIndex, action, brightness)
-
-    def setOff(self, moduleAddr, outputIndex):
+    async def setOff(self, moduleAddr, outputIndex):
         """Switch an output off."""
+        return await self.sendAction(moduleAddr, outputIndex, DobissSystem.Action.TurnOff)
 
-        action = DobissSystem.Action.TurnOff
-        self.sendAction(moduleAddr, outputIndex, action)
-
-    def toggle(self, moduleAddr, outputIndex):
+    async def toggle(self, moduleAddr, outputIndex):
         """Toggle an output."""
+        return await self.sendAction(moduleAddr, outputIndex, DobissSystem.Action.Toggle)
 
-        action = DobissSystem.Action.Toggle
-        self.sendAction(moduleAddr, outputIndex, action)
+    async def sendAction(self, moduleAddr, outputIndex, action, value = 100, delayOn = 0xFF, delayOff = 0xFF, softDim = 0xFF, red = 0xFF):
+        """Generic method to send an action to an output.
+           Actions arriving within actionWindow seconds of each other (e.g. from a scene) are
+           coalesced and written as one burst. Returns True if both frames of the action were echoed.
+        """
+        if self._closed:
+            raise ConnectionError("Dobiss system is closed")
 
-    def sendAction(self, moduleAddr, outputIndex, action, value = 100, delayOn = 0xFF, delayOff = 0xFF, softDim = 0xFF, red = 0xFF):
-        """Generic method to send an action to an output."""
+        future = asyncio.get_running_loop().create_future()
+        self._pendingActions.append((actionRequests(moduleAddr, outputIndex, action, value, delayOn, delayOff, softDim, red), future))
 
-        # Send the request header
-        headerData = bytearray.fromhex("AF 02 FF " + f"{moduleAddr:02x}" + " 00 00 08 01 08 FF FF FF FF FF FF AF")
-        self.sendData(headerData)
+        # The first action of a burst schedules the flush
+        if len(self._pendingActions) == 1:
+            asyncio.ensure_future(self._flushActions())
 
-        # Note: no additional data is sent back
-        self.receiveResponse(len(headerData), 0)
+        return await future
 
-        # Send the request data
-        requestData = bytes((moduleAddr, outputIndex, action.value, delayOn, delayOff, int(value), softDim, red))
-        self.sendData(requestData)
+    async def sendActions(self, actions):
+        """Send several actions in one burst.
+           actions is a list of argument tuples for sendAction: (moduleAddr, outputIndex, action[, value, ...]).
+           Returns True if all echoes were received.
+        """
+        return await self.sendActionRequests([ request for args in actions for request in actionRequests(*args) ])
 
-        # Note: no additional data is sent back
-        self.receiveResponse(len(requestData), 0)
+    async def sendActionRequests(self, requests):
+        """Send already encoded action requests (see actionRequests and sceneRequests) in one burst.
+           Returns True if all echoes were received.
+        """
+        return allReceived(await self.requestBurst(requests, AsyncDobissSystem.Priority.Action), requests)
+
+    async def _flushActions(self):
+        """Send the pending actions as one burst once the action window has passed."""
+        if self.actionWindow > 0:
+            await asyncio.sleep(self.actionWindow)
+
+        pendingActions = self._pendingActions
+        self._pendingActions = [ ]
+
+        requests = [ request for actionRequests, future in pendingActions for request in actionRequests ]
+        try:
+            responses = await self.requestBurst(requests, AsyncDobissSystem.Priority.Action)
+        except Exception as e:
+            for actionRequests, future in pendingActions:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        # The responses are in order: an action succeeded if both its own frames were echoed
+        for number, (actionRequests, future) in enumerate(pendingActions):
+            if not future.done():
+                future.set_result(allReceived(responses[2 * number:2 * number + 2], actionRequests))
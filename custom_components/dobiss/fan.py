@@ -1,10 +1,13 @@
 """Dobiss Fan Control"""
 import logging
+from dataclasses import asdict
 import voluptuous as vol
 from .dobiss import DobissSystem
 from .const import DOMAIN
 
 from homeassistant.components.fan import FanEntity
+from homeassistant.core import callback
+from homeassistant.helpers.dispatcher import async_dispatcher_connect
 from homeassistant.helpers.update_coordinator import CoordinatorEntity
 
 
@@ -13,18 +16,27 @@ _LOGGER = logging.getLogger(__name__)
         
 async def async_setup_entry(hass, config_entry, async_add_entities):
     """Setup the Dobiss Fan platform."""
-    coordinator = hass.data[DOMAIN]["coordinator"]
+    coordinator = hass.data[DOMAIN][config_entry.entry_id]
 
-    fans = coordinator.dobiss.fans
-    _LOGGER.info("Adding fans...")
-    _LOGGER.debug(str(fans))
+    @callback
+    def addFans(outputs):
+        fans = [ output for output in outputs if output.type == DobissSystem.OutputType.Fan ]
+        if not fans:
+            return
 
-    # Add devices
-    async_add_entities(
-        HomeAssistantDobissFan(coordinator, fan) for fan in fans
-    )
-    
-    _LOGGER.info("Dobiss fans added.")
+        _LOGGER.info(f"Adding {len(fans)} fans...")
+        _LOGGER.debug(str(fans))
+
+        # Add devices
+        async_add_entities(
+            HomeAssistantDobissFan(coordinator, fan) for fan in fans
+        )
+
+        _LOGGER.info("Dobiss fans added.")
+
+    # The fans of modules that are imported later are added as they come in
+    config_entry.async_on_unload(async_dispatcher_connect(hass, coordinator.outputsAddedSignal, addFans))
+    addFans(coordinator.announcedOutputs())
 
 
 class HomeAssistantDobissFan(CoordinatorEntity, FanEntity):
@@ -32,45 +44,48 @@ class HomeAssistantDobissFan(CoordinatorEntity, FanEntity):
 
     def __init__(self, coordinator, fan):
         """Pass coordinator to CoordinatorEntity."""
-        super().__init__(coordinator)
+        super().__init__(coordinator, context=fan.key)
 
         """Initialize a DobissFan."""
         self.dobiss = coordinator.dobiss
         self._fan = fan
-        self._name = fan['name']
+
+        # The live values of its module and its index in there, so a state read is a single lookup
+        self._values = coordinator.dobiss.valuesOf(fan.moduleAddress)
+        self._index = fan.index
 
 
     @property
     def unique_id(self):
-        return "{}.{}".format(self._fan['moduleAddress'], self._fan['index'])
+        return self.coordinator.uniqueId(self._fan.moduleAddress, self._fan.index)
 
     @property
     def device_extra_attributes(self):
         """Return device specific state attributes."""
-        return self._fan
+        return asdict(self._fan)
     
     @property
     def name(self):
         """Return the display name of this fan."""
-        return self._name
+        return self._fan.name
 
     @property
     def is_on(self):
         """Return true if the fan is on."""
-        val = self.coordinator.data[self._fan['moduleAddress']][self._fan['index']]
+        val = self._values[self._index]
         return (val > 0)
 
     async def async_turn_on(self, **kwargs):
         """Instruct the fan to turn on.
         """
-        self.dobiss.setOn(self._fan['moduleAddress'], self._fan['index'])
+        confirmed = await self.dobiss.setOn(self._fan.moduleAddress, self._fan.index)
 
-        # Poll states
-        await self.coordinator.async_request_refresh()
+        # Show the new state if the controller echoed the command, and verify it
+        await self.coordinator.applyCommand(self._fan.moduleAddress, self._fan.index, 100, confirmed)
 
     async def async_turn_off(self, **kwargs):
         """Instruct the fan to turn off."""
-        self.dobiss.setOff(self._fan['moduleAddress'], self._fan['index'])
+        confirmed = await self.dobiss.setOff(self._fan.moduleAddress, self._fan.index)
 
-        # Poll states
-        await self.coordinator.async_request_refresh()
+        # Show the new state if the controller echoed the command, and verify it
+        await self.coordinator.applyCommand(self._fan.moduleAddress, self._fan.index, 0, confirmed)
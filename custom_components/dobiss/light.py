@@ -1,10 +1,13 @@
 """Dobiss Light Control"""
 import logging
+from dataclasses import asdict
 import voluptuous as vol
 from .dobiss import DobissSystem
 from .const import DOMAIN
 
 from homeassistant.components.light import SUPPORT_BRIGHTNESS, ATTR_BRIGHTNESS, LightEntity, LightEntityFeature
+from homeassistant.core import callback
+from homeassistant.helpers.dispatcher import async_dispatcher_connect
 from homeassistant.helpers.update_coordinator import CoordinatorEntity
 
 
@@ -13,18 +16,27 @@ _LOGGER = logging.getLogger(__name__)
         
 async def async_setup_entry(hass, config_entry, async_add_entities):
     """Setup the Dobiss Light platform."""
-    coordinator = hass.data[DOMAIN]["coordinator"]
+    coordinator = hass.data[DOMAIN][config_entry.entry_id]
 
-    lights = coordinator.dobiss.lights
-    _LOGGER.info("Adding lights...")
-    _LOGGER.debug(str(lights))
+    @callback
+    def addLights(outputs):
+        lights = [ output for output in outputs if output.type == DobissSystem.OutputType.Light ]
+        if not lights:
+            return
 
-    # Add devices
-    async_add_entities(
-        HomeAssistantDobissLight(coordinator, light) for light in lights
-    )
-    
-    _LOGGER.info("Dobiss lights added.")
+        _LOGGER.info(f"Adding {len(lights)} lights...")
+        _LOGGER.debug(str(lights))
+
+        # Add devices
+        async_add_entities(
+            HomeAssistantDobissLight(coordinator, light) for light in lights
+        )
+
+        _LOGGER.info("Dobiss lights added.")
+
+    # The lights of modules that are imported later are added as they come in
+    config_entry.async_on_unload(async_dispatcher_connect(hass, coordinator.outputsAddedSignal, addLights))
+    addLights(coordinator.announcedOutputs())
 
 
 class HomeAssistantDobissLight(CoordinatorEntity, LightEntity):
@@ -32,33 +44,36 @@ class HomeAssistantDobissLight(CoordinatorEntity, LightEntity):
 
     def __init__(self, coordinator, light):
         """Pass coordinator to CoordinatorEntity."""
-        super().__init__(coordinator)
+        super().__init__(coordinator, context=light.key)
 
         """Initialize a DobissLight."""
         self.dobiss = coordinator.dobiss
         self._light = light
-        self._name = light['name']
+
+        # The live values of its module and its index in there, so a state read is a single lookup
+        self._values = coordinator.dobiss.valuesOf(light.moduleAddress)
+        self._index = light.index
 
     @property
     def supported_features(self):
-        if self.dobiss.modules[self._light['moduleAddress']]['type'] == DobissSystem.ModuleType.Relais:
+        if self.dobiss.modules[self._light.moduleAddress].type == DobissSystem.ModuleType.Relais:
             return LightEntityFeature.FLASH | LightEntityFeature.TRANSITION
         else:
             return LightEntityFeature.FLASH | LightEntityFeature.TRANSITION
 
     @property
     def unique_id(self):
-        return "{}.{}".format(self._light['moduleAddress'], self._light['index'])
+        return self.coordinator.uniqueId(self._light.moduleAddress, self._light.index)
 
     @property
     def device_extra_attributes(self):
         """Return device specific state attributes."""
-        return self._light
+        return asdict(self._light)
     
     @property
     def name(self):
         """Return the display name of this light."""
-        return self._name
+        return self._light.name
 
     @property
     def brightness(self):
@@ -67,13 +82,13 @@ class HomeAssistantDobissLight(CoordinatorEntity, LightEntity):
         This method is optional. Removing it indicates to Home Assistant
         that brightness is not supported for this light.
         """
-        val = self.coordinator.data[self._light['moduleAddress']][self._light['index']]
+        val = self._values[self._index]
         return int(val * 255 / 100)
 
     @property
     def is_on(self):
         """Return true if light is on."""
-        val = self.coordinator.data[self._light['moduleAddress']][self._light['index']]
+        val = self._values[self._index]
         return (val > 0)
 
     async def async_turn_on(self, **kwargs):
@@ -83,14 +98,14 @@ class HomeAssistantDobissLight(CoordinatorEntity, LightEntity):
         brightness control.
         """
         pct = int(kwargs.get(ATTR_BRIGHTNESS, 255) * 100 / 255)
-        self.dobiss.setOn(self._light['moduleAddress'], self._light['index'], pct)
+        confirmed = await self.dobiss.setOn(self._light.moduleAddress, self._light.index, pct)
 
-        # Poll states
-        await self.coordinator.async_request_refresh()
+        # Show the new state if the controller echoed the command, and verify it
+        await self.coordinator.applyCommand(self._light.moduleAddress, self._light.index, pct, confirmed)
 
     async def async_turn_off(self, **kwargs):
         """Instruct the light to turn off."""
-        self.dobiss.setOff(self._light['moduleAddress'], self._light['index'])
+        confirmed = await self.dobiss.setOff(self._light.moduleAddress, self._light.index)
 
-        # Poll states
-        await self.coordinator.async_request_refresh()
+        # Show the new state if the controller echoed the command, and verify it
+        await self.coordinator.applyCommand(self._light.moduleAddress, self._light.index, 0, confirmed)
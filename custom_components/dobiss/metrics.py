@@ -0,0 +1,110 @@
+"""
+Performance counters for the communication with a Dobiss LAN controller.
+"""
+
+import time
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5)
+
+
+class LatencyHistogram:
+    """Histogram of latencies with fixed buckets, plus count, sum, minimum and maximum."""
+
+    def __init__(self, buckets = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [ 0 ] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, seconds):
+        """Record a latency."""
+        index = 0
+        while index < len(self.buckets) and seconds > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+
+        self.count += 1
+        self.sum += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    def percentile(self, percentile):
+        """The upper bound of the bucket holding the given percentile (0-100), or None without data.
+           For the last, unbounded bucket this is the maximum.
+        """
+        if not self.count:
+            return None
+
+        rank = percentile / 100 * self.count
+        total = 0
+        for index, count in enumerate(self.counts):
+            total += count
+            if total >= rank and count:
+                return self.buckets[index] if index < len(self.buckets) else self.max
+        return self.max
+
+    def asDict(self):
+        """The histogram as JSON-serializable data, with latencies in milliseconds."""
+        def ms(seconds):
+            return None if seconds is None else round(seconds * 1000, 3)
+
+        return {
+            'count': self.count,
+            'mean': ms(self.mean),
+            'min': ms(self.min),
+            'max': ms(self.max),
+            'p50': ms(self.percentile(50)),
+            'p95': ms(self.percentile(95)),
+            'p99': ms(self.percentile(99)),
+            'buckets': { f"<={ms(bound)}": count for bound, count in zip(self.buckets, self.counts) } | { 'more': self.counts[-1] }
+        }
+
+
+class DobissMetrics:
+    """Counters of a Dobiss system: latency per frame type, poll duration, bytes and errors."""
+
+    FRAME_TYPES = ('status', 'action', 'import')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Start counting from zero."""
+        self.since = time.time()
+        self.latency = { frameType: LatencyHistogram() for frameType in DobissMetrics.FRAME_TYPES }
+        self.pollDuration = LatencyHistogram()
+        self.bytesSent = 0
+        self.bytesReceived = 0
+        self.framesSent = 0
+        self.framesReceived = 0
+        self.retries = 0
+        self.failures = 0
+
+    def recordFrame(self, frameType, seconds):
+        """Record the latency of a response: from sending the request to receiving its response."""
+        self.latency[frameType].record(seconds)
+
+    def recordPoll(self, seconds):
+        """Record the duration of a status poll."""
+        self.pollDuration.record(seconds)
+
+    def asDict(self):
+        """All counters as JSON-serializable data."""
+        return {
+            'since': self.since,
+            'latency': { frameType: histogram.asDict() for frameType, histogram in self.latency.items() },
+            'pollDuration': self.pollDuration.asDict(),
+            'bytesSent': self.bytesSent,
+            'bytesReceived': self.bytesReceived,
+            'framesSent': self.framesSent,
+            'framesReceived': self.framesReceived,
+            'retries': self.retries,
+            'failures': self.failures
+        }
@@ -0,0 +1,132 @@
+"""
+Adaptive polling of the modules of a Dobiss installation.
+"""
+
+
+class PollScheduler:
+    """Decides which modules to poll on every tick of the coordinator.
+
+       Every module has its own interval in ticks, between minInterval and maxInterval.
+       A module whose values changed is polled twice as often; a module that didn't change
+       is polled a tick less often each time, up to maxInterval. A module an entity just sent
+       a command to is polled at the fastest rate again.
+       Modules start at defaultInterval with staggered phases, and a module is scheduled on the
+       least busy tick within a quarter of its interval, so the polls stay spread over the ticks
+       and no tick has to poll the whole installation. After a sweep (all modules polled at once,
+       e.g. after a failed update) the next polls are spread over the whole interval instead.
+
+       Once the controller reports changes unsolicited, polls are only a safety net: quiet modules
+       back off up to reportInterval instead of maxInterval. A poll that finds a change that wasn't
+       reported means reports can't be relied on, and the intervals fall back to maxInterval.
+    """
+
+    def __init__(self, defaultInterval, minInterval = 1, maxInterval = None, reportInterval = None):
+        self.defaultInterval = defaultInterval
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval if maxInterval is not None else 3 * defaultInterval
+        self.reportInterval = reportInterval if reportInterval is not None else 4 * self.maxInterval
+
+        # True while changes are reported by the controller
+        self.reporting = False
+
+        self.tick = 0
+        self._intervals = { }
+        self._nextDue = { }
+        # Number of modules due per tick
+        self._load = { }
+
+    def __contains__(self, moduleAddr):
+        return moduleAddr in self._intervals
+
+    def interval(self, moduleAddr):
+        """The current interval of a module, in ticks."""
+        return self._intervals[moduleAddr]
+
+    def setModules(self, moduleAddrs):
+        """Follow the given modules: new modules are added with a staggered phase, gone modules are removed."""
+        moduleAddrs = list(moduleAddrs)
+
+        for moduleAddr in list(self._intervals):
+            if moduleAddr not in moduleAddrs:
+                self._unschedule(moduleAddr)
+                del self._intervals[moduleAddr]
+
+        for number, moduleAddr in enumerate(moduleAddrs):
+            if moduleAddr not in self._intervals:
+                self._intervals[moduleAddr] = self.defaultInterval
+                self._schedule(moduleAddr, self.tick + 1 + (number % self.defaultInterval))
+
+    def advance(self):
+        """Go to the next tick and return the modules that are due."""
+        self._load.pop(self.tick, None)
+        self.tick += 1
+        return [ moduleAddr for moduleAddr, nextDue in self._nextDue.items() if nextDue <= self.tick ]
+
+    def polled(self, moduleAddr, changed, sweep = False):
+        """Adapt the interval of a module after it was polled.
+           sweep means all modules were polled on this tick.
+        """
+        if moduleAddr not in self._intervals:
+            return
+
+        if changed and self.reporting:
+            # The change wasn't reported
+            self.fallBack()
+
+        interval = self._intervals[moduleAddr]
+        if changed:
+            interval = max(self.minInterval, interval // 2)
+        else:
+            interval = min(self.reportInterval if self.reporting else self.maxInterval, interval + 1)
+
+        self._reschedule(moduleAddr, interval, interval - 1 if sweep else None)
+
+    def reported(self, moduleAddr):
+        """A module reported a change unsolicited: it doesn't have to be polled for it."""
+        if moduleAddr not in self._intervals:
+            return
+
+        self.reporting = True
+        self._reschedule(moduleAddr, max(self._intervals[moduleAddr], self.defaultInterval))
+
+    def fallBack(self):
+        """Stop relying on reports: poll every module at maxInterval or faster again."""
+        self.reporting = False
+
+        for moduleAddr, interval in self._intervals.items():
+            if interval > self.maxInterval or self._nextDue[moduleAddr] > self.tick + self.maxInterval:
+                self._reschedule(moduleAddr, min(interval, self.maxInterval))
+
+    def touch(self, moduleAddr):
+        """Mark recent user activity on a module: poll it at the fastest rate, starting next tick."""
+        if moduleAddr not in self._intervals:
+            return
+
+        self._intervals[moduleAddr] = self.minInterval
+        self._schedule(moduleAddr, self.tick + 1)
+
+    def _reschedule(self, moduleAddr, interval, window = None):
+        """Set the interval of a module and schedule it on the least busy tick within <window> ticks
+           before the end of the interval (a quarter of the interval by default), preferring the latest.
+        """
+        self._intervals[moduleAddr] = interval
+        if window is None:
+            window = interval // 4
+
+        candidates = range(self.tick + interval, self.tick + interval - window - 1, -1)
+        self._schedule(moduleAddr, min(candidates, key = lambda tick: self._load.get(tick, 0)))
+
+    def _schedule(self, moduleAddr, tick):
+        self._unschedule(moduleAddr)
+        self._nextDue[moduleAddr] = tick
+        self._load[tick] = self._load.get(tick, 0) + 1
+
+    def _unschedule(self, moduleAddr):
+        tick = self._nextDue.pop(moduleAddr, None)
+        if tick in self._load:
+            self._load[tick] -= 1
+
+    @property
+    def pollsPerTick(self):
+        """The average number of module polls per tick at the current intervals."""
+        return sum(1 / interval for interval in self._intervals.values())
@@ -0,0 +1,71 @@
+"""Dobiss Connection Statistics"""
+import logging
+from .const import DOMAIN
+
+from homeassistant.components.sensor import SensorEntity, SensorStateClass
+from homeassistant.const import UnitOfInformation, UnitOfTime
+from homeassistant.helpers.entity import EntityCategory
+from homeassistant.helpers.update_coordinator import CoordinatorEntity
+
+
+_LOGGER = logging.getLogger(__name__)
+
+
+# (key, name, unit, state class, function of the statistics)
+SENSORS = [
+    ("status_latency", "Status latency", UnitOfTime.MILLISECONDS, SensorStateClass.MEASUREMENT,
+     lambda stats: stats['latency']['status']['p95']),
+    ("action_latency", "Action latency", UnitOfTime.MILLISECONDS, SensorStateClass.MEASUREMENT,
+     lambda stats: stats['latency']['action']['p95']),
+    ("poll_duration", "Poll duration", UnitOfTime.MILLISECONDS, SensorStateClass.MEASUREMENT,
+     lambda stats: stats['pollDuration']['p95']),
+    ("bytes_sent", "Bytes sent", UnitOfInformation.BYTES, SensorStateClass.TOTAL_INCREASING,
+     lambda stats: stats['bytesSent']),
+    ("bytes_received", "Bytes received", UnitOfInformation.BYTES, SensorStateClass.TOTAL_INCREASING,
+     lambda stats: stats['bytesReceived']),
+    ("retries", "Retries", None, SensorStateClass.TOTAL_INCREASING,
+     lambda stats: stats['retries']),
+    ("failures", "Failures", None, SensorStateClass.TOTAL_INCREASING,
+     lambda stats: stats['failures']),
+    ("reconnects", "Reconnects", None, SensorStateClass.TOTAL_INCREASING,
+     lambda stats: stats['reconnects']),
+    ("reports", "Status reports", None, SensorStateClass.TOTAL_INCREASING,
+     lambda stats: stats['reports']),
+]
+
+
+async def async_setup_entry(hass, config_entry, async_add_entities):
+    """Setup the Dobiss statistics platform."""
+    coordinator = hass.data[DOMAIN][config_entry.entry_id]
+
+    # Add devices
+    async_add_entities(
+        HomeAssistantDobissStatistic(coordinator, *sensor) for sensor in SENSORS
+    )
+
+    _LOGGER.info("Dobiss statistics added.")
+
+
+class HomeAssistantDobissStatistic(CoordinatorEntity, SensorEntity):
+    """A performance counter of the connection to the Dobiss controller.
+       Disabled by default; the same counters are in the diagnostics download.
+    """
+
+    _attr_entity_category = EntityCategory.DIAGNOSTIC
+    _attr_entity_registry_enabled_default = False
+
+    def __init__(self, coordinator, key, name, unit, stateClass, value):
+        """Pass coordinator to CoordinatorEntity."""
+        super().__init__(coordinator)
+
+        self.dobiss = coordinator.dobiss
+        self._value = value
+        self._attr_name = f"Dobiss {self.dobiss.host} {name}"
+        self._attr_unique_id = f"{coordinator.entryId}_{key}"
+        self._attr_native_unit_of_measurement = unit
+        self._attr_state_class = stateClass
+
+    @property
+    def native_value(self):
+        """Return the current value of the counter."""
+        return self._value(self.dobiss.statistics())
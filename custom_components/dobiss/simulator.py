@@ -0,0 +1,367 @@
+"""
+Stand-in for a Dobiss LAN controller, for testing and measuring without a real installation.
+
+Speaks the subset of the 0xAF frame protocol used by dobiss.py:
+    AF 0B ...            installation (bitmap of available modules)
+    AF 10 FF <addr> ...  module query
+    AF 10 <type> <addr>  output names
+    AF 01 <type> <addr>  status of the outputs of a module
+    AF 02 FF <addr> ...  action header, followed by an 8-byte action payload
+Every received frame is echoed back padded to 32 bytes, followed by the response padded to 32 bytes,
+just like the real controller.
+
+With reportChanges, every change of an output (by an action, or by press() for a wall switch)
+is also reported to all clients unsolicited, as a status frame and status data, the way a status
+request is answered.
+
+Run it standalone with e.g.:
+    python simulator.py --modules 12 --port 10001 --latency 0.002
+and point test.py (or Home Assistant) to it. Add e.g. --report-changes --press-interval 5
+to have it press a random wall switch every 5 seconds and report it.
+"""
+
+import argparse
+import asyncio
+import random
+
+FRAME_SIZE = 16
+ACTION_SIZE = 8
+PADDING = 32
+MAX_MODULES = 82
+
+RELAIS = 0x08
+DIMMER = 0x10
+V0_10 = 0x18
+
+LIGHT = 0x00
+PLUG = 0x01
+FAN = 0x02
+
+
+def pad(data):
+    """Pad data to a multiple of 32 bytes, the way the controller does."""
+    return bytes(data) + bytes((PADDING - (len(data) % PADDING)) % PADDING)
+
+
+class SimulatedModule:
+    """A module of the simulated installation."""
+
+    def __init__(self, address, moduleType, isMaster = False, outputs = None):
+        self.address = address
+        self.type = moduleType
+        self.isMaster = isMaster
+        self.outputCount = 12 if moduleType == RELAIS else 4
+
+        # List of (name, icon, group index)
+        if outputs is None:
+            outputs = [ ]
+            for index in range(self.outputCount):
+                icon = (LIGHT, LIGHT, PLUG, FAN)[index % 4] if moduleType == RELAIS else LIGHT
+                outputs.append((f"Output {address}.{index}", icon, 0))
+        self.outputs = outputs
+
+        self.values = bytearray(self.outputCount)
+
+    def moduleData(self):
+        """The response to a module query."""
+        data = bytearray(FRAME_SIZE)
+        data[0] = self.address
+        data[2] = 1 if self.isMaster else 0
+        data[14] = self.type
+        return data
+
+    def outputsData(self):
+        """The response to an output names query: one line of 32 bytes per output."""
+        data = bytearray()
+        for name, icon, groupIndex in self.outputs:
+            line = bytearray(name.encode()[:30].ljust(30))
+            line.append(icon)
+            line.append(groupIndex)
+            data += line
+        return data
+
+    def statusData(self):
+        """The response to a status query."""
+        data = bytearray(b'\xFF' * FRAME_SIZE)
+        data[0:self.outputCount] = self.values
+        return data
+
+    def statusFrame(self):
+        """The status request of this module, as it is echoed."""
+        return bytes([ 0xAF, 0x01, self.type, self.address, 0x00, 0x00, 0x00, 0x01, 0x00 ]) + b'\xFF' * 6 + b'\xAF'
+
+    def apply(self, outputIndex, action, value):
+        """Apply an action to an output. Relais outputs report 1 when on, dimmers their level.
+           Returns True if the value of the output changed.
+        """
+        if outputIndex >= self.outputCount:
+            return False
+
+        previous = self.values[outputIndex]
+        onValue = 1 if self.type == RELAIS else min(value, 100)
+        if action == 0x00:
+            self.values[outputIndex] = 0
+        elif action == 0x01:
+            self.values[outputIndex] = onValue
+        elif action == 0x02:
+            self.values[outputIndex] = 0 if self.values[outputIndex] > 0 else onValue
+        return self.values[outputIndex] != previous
+
+
+def createModules(count, dimmerRatio = 0.25):
+    """Create an installation of <count> modules (up to 82), with a share of dimmers."""
+    count = max(1, min(count, MAX_MODULES))
+    numDimmers = int(count * dimmerRatio)
+
+    modules = { }
+    for i in range(count):
+        address = i + 1
+        moduleType = DIMMER if i >= count - numDimmers else RELAIS
+        modules[address] = SimulatedModule(address, moduleType, isMaster = (i == 0))
+    return modules
+
+
+class DobissSimulator:
+    """A TCP server behaving like a Dobiss LAN controller.
+
+       latency: delay in seconds before every response, holding up the next frames (a slow bus)
+       rtt: network round trip time in seconds: responses are delayed without holding up the next frames
+       jitter: random extra delay of up to this many seconds
+       dropRate: probability of closing the connection instead of answering a frame
+       chunkSize: if set, responses are written in random chunks of at most this size (partial reads)
+       glitchRate: probability of corrupting the stream around a response, with a stray byte
+           before the echo or a missing last byte
+       reportChanges: report every change of an output to all clients, unsolicited
+    """
+
+    def __init__(self, modules = None, host = "127.0.0.1", port = 0, latency = 0.0, jitter = 0.0,
+                 dropRate = 0.0, chunkSize = None, glitchRate = 0.0, rtt = 0.0, reportChanges = False, seed = None):
+        self.modules = modules if modules is not None else createModules(4)
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.dropRate = dropRate
+        self.chunkSize = chunkSize
+        self.glitchRate = glitchRate
+        self.rtt = rtt
+        self.reportChanges = reportChanges
+        self.random = random.Random(seed)
+
+        self.framesReceived = 0
+        self.connections = 0
+        self.glitches = 0
+        self.reportsSent = 0
+        self._server = None
+        self._writers = set()
+        self._clients = set()
+        # The send function of every client, by writer
+        self._senders = { }
+
+    async def start(self):
+        """Start listening. With port 0 a free port is picked; see self.port."""
+        self._server = await asyncio.start_server(self._handleClient, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        """Stop listening and close all client connections."""
+        if self._server is not None:
+            self._server.close()
+            for writer in list(self._writers):
+                writer.close()
+            await asyncio.gather(*self._clients, return_exceptions = True)
+            await self._server.wait_closed()
+            self._server = None
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    async def serve_forever(self):
+        await self._server.serve_forever()
+
+    def installationData(self):
+        """The response to an installation query: bit (address - 1) is set for every module."""
+        data = bytearray(FRAME_SIZE)
+        for address in self.modules:
+            data[(address - 1) // 8] |= 1 << ((address - 1) % 8)
+        return data
+
+    async def press(self, address, outputIndex):
+        """Toggle an output like its wall switch does, and report the change."""
+        module = self.modules.get(address)
+        if module is not None and module.apply(outputIndex, 0x02, 100):
+            await self.report(module)
+
+    async def report(self, module):
+        """Send the status of a module to all clients, unsolicited, if changes are reported."""
+        if not self.reportChanges:
+            return
+
+        data = pad(module.statusFrame()) + pad(module.statusData())
+        for send in list(self._senders.values()):
+            self.reportsSent += 1
+            try:
+                await send(data)
+            except ConnectionError:
+                # That client is gone
+                pass
+
+    def respond(self, frame):
+        """Return the response data for a received 16-byte frame, or None for an unknown frame."""
+        command = frame[1]
+        address = frame[3]
+        module = self.modules.get(address)
+
+        if command == 0x0B:
+            return self.installationData()
+        if command == 0x10 and frame[2] == 0xFF:
+            return module.moduleData() if module else bytearray(FRAME_SIZE)
+        if command == 0x10:
+            return module.outputsData() if module else bytearray(PADDING * frame[7])
+        if command == 0x01:
+            return module.statusData() if module else bytearray(b'\xFF' * FRAME_SIZE)
+        if command == 0x02:
+            return bytearray()
+        return None
+
+    async def _write(self, writer, data):
+        """Write data after the configured delay, in chunks if partial reads are simulated."""
+        delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        if self.glitchRate and self.random.random() < self.glitchRate:
+            self.glitches += 1
+            data = (b'\x00' + data) if self.random.random() < 0.5 else data[:-1]
+
+        if not self.chunkSize:
+            writer.write(data)
+        else:
+            offset = 0
+            while offset < len(data):
+                size = self.random.randint(1, self.chunkSize)
+                writer.write(data[offset:offset + size])
+                await writer.drain()
+                offset += size
+                # Let the other side see a partial frame
+                await asyncio.sleep(0)
+        await writer.drain()
+
+    async def _sendDelayed(self, writer, outgoing):
+        """Write the queued (time, data) responses in order, each at its time."""
+        loop = asyncio.get_running_loop()
+        while True:
+            sendAt, data = await outgoing.get()
+            if sendAt > loop.time():
+                await asyncio.sleep(sendAt - loop.time())
+            await self._write(writer, data)
+
+    async def _handleClient(self, reader, writer):
+        self.connections += 1
+        self._writers.add(writer)
+        self._clients.add(asyncio.current_task())
+
+        # With a round trip time, responses are written by a separate task
+        loop = asyncio.get_running_loop()
+        outgoing = asyncio.Queue() if self.rtt else None
+        sender = asyncio.ensure_future(self._sendDelayed(writer, outgoing)) if outgoing else None
+
+        # Reports are written by other clients' handlers too, so whole writes are serialized
+        lock = asyncio.Lock()
+
+        async def send(data):
+            if outgoing is None:
+                async with lock:
+                    await self._write(writer, data)
+            else:
+                outgoing.put_nowait((loop.time() + self.rtt, data))
+
+        self._senders[writer] = send
+
+        try:
+            while True:
+                frame = await reader.readexactly(FRAME_SIZE)
+                self.framesReceived += 1
+
+                if self.dropRate and self.random.random() < self.dropRate:
+                    break
+
+                response = self.respond(frame)
+                if response is None:
+                    # Unknown frame: only echo it
+                    await send(pad(frame))
+                    continue
+
+                await send(pad(frame) + (pad(response) if response else b''))
+
+                # An action header is followed by the action payload
+                if frame[1] == 0x02:
+                    action = await reader.readexactly(ACTION_SIZE)
+                    self.framesReceived += 1
+
+                    module = self.modules.get(action[0])
+                    changed = module is not None and module.apply(action[1], action[2], action[5])
+
+                    await send(pad(action))
+
+                    if changed:
+                        await self.report(module)
+
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+        finally:
+            if sender is not None:
+                sender.cancel()
+            self._writers.discard(writer)
+            self._senders.pop(writer, None)
+            self._clients.discard(asyncio.current_task())
+            writer.close()
+
+
+async def main(args):
+    simulator = DobissSimulator(
+        createModules(args.modules, args.dimmers), host = args.host, port = args.port,
+        latency = args.latency, jitter = args.jitter, dropRate = args.drop_rate,
+        chunkSize = args.chunk_size, glitchRate = args.glitch_rate, rtt = args.rtt,
+        reportChanges = args.report_changes, seed = args.seed)
+
+    await simulator.start()
+    print(f"Simulated Dobiss controller with {len(simulator.modules)} modules listening on {simulator.host}:{simulator.port}")
+
+    if args.press_interval:
+        # Somebody presses a random wall switch now and then
+        while True:
+            await asyncio.sleep(args.press_interval)
+            module = simulator.random.choice(list(simulator.modules.values()))
+            outputIndex = simulator.random.randrange(module.outputCount)
+            print(f"Pressing the switch of output {module.address}.{outputIndex}")
+            await simulator.press(module.address, outputIndex)
+
+    await simulator.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Simulated Dobiss LAN controller")
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 10001)
+    parser.add_argument("--modules", type = int, default = 4, help = f"number of modules (1-{MAX_MODULES})")
+    parser.add_argument("--dimmers", type = float, default = 0.25, help = "share of dimmer modules")
+    parser.add_argument("--latency", type = float, default = 0.0, help = "delay per frame in seconds")
+    parser.add_argument("--rtt", type = float, default = 0.0, help = "network round trip time in seconds")
+    parser.add_argument("--jitter", type = float, default = 0.0, help = "random extra delay per frame in seconds")
+    parser.add_argument("--drop-rate", type = float, default = 0.0, help = "probability of dropping the connection per frame")
+    parser.add_argument("--chunk-size", type = int, default = None, help = "write responses in random chunks of at most this size")
+    parser.add_argument("--glitch-rate", type = float, default = 0.0, help = "probability of a stray or missing byte per response")
+    parser.add_argument("--report-changes", action = "store_true", help = "report output changes to the clients unsolicited")
+    parser.add_argument("--press-interval", type = float, default = None, help = "press a random wall switch every this many seconds")
+    parser.add_argument("--seed", type = int, default = None)
+
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
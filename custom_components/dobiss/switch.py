@@ -1,10 +1,13 @@
 """Dobiss Plug Control"""
 import logging
+from dataclasses import asdict
 import voluptuous as vol
 from .dobiss import DobissSystem
 from .const import DOMAIN
 
 from homeassistant.components.switch import SwitchEntity, SwitchDeviceClass
+from homeassistant.core import callback
+from homeassistant.helpers.dispatcher import async_dispatcher_connect
 from homeassistant.helpers.update_coordinator import CoordinatorEntity
 
 
@@ -13,18 +16,27 @@ _LOGGER = logging.getLogger(__name__)
         
 async def async_setup_entry(hass, config_entry, async_add_entities):
     """Setup the Dobiss Plug platform."""
-    coordinator = hass.data[DOMAIN]["coordinator"]
+    coordinator = hass.data[DOMAIN][config_entry.entry_id]
 
-    plugs = coordinator.dobiss.plugs
-    _LOGGER.info("Adding plugs...")
-    _LOGGER.debug(str(plugs))
+    @callback
+    def addPlugs(outputs):
+        plugs = [ output for output in outputs if output.type == DobissSystem.OutputType.Plug ]
+        if not plugs:
+            return
 
-    # Add devices
-    async_add_entities(
-        HomeAssistantDobissPlug(coordinator, plug) for plug in plugs
-    )
-    
-    _LOGGER.info("Dobiss plugs added.")
+        _LOGGER.info(f"Adding {len(plugs)} plugs...")
+        _LOGGER.debug(str(plugs))
+
+        # Add devices
+        async_add_entities(
+            HomeAssistantDobissPlug(coordinator, plug) for plug in plugs
+        )
+
+        _LOGGER.info("Dobiss plugs added.")
+
+    # The plugs of modules that are imported later are added as they come in
+    config_entry.async_on_unload(async_dispatcher_connect(hass, coordinator.outputsAddedSignal, addPlugs))
+    addPlugs(coordinator.announcedOutputs())
 
 
 class HomeAssistantDobissPlug(CoordinatorEntity, SwitchEntity):
@@ -32,27 +44,30 @@ class HomeAssistantDobissPlug(CoordinatorEntity, SwitchEntity):
 
     def __init__(self, coordinator, plug):
         """Pass coordinator to CoordinatorEntity."""
-        super().__init__(coordinator)
+        super().__init__(coordinator, context=plug.key)
 
         """Initialize a DobissPlug."""
         self.dobiss = coordinator.dobiss
         self._plug = plug
-        self._name = plug['name']
+
+        # The live values of its module and its index in there, so a state read is a single lookup
+        self._values = coordinator.dobiss.valuesOf(plug.moduleAddress)
+        self._index = plug.index
 
 
     @property
     def unique_id(self):
-        return "{}.{}".format(self._plug['moduleAddress'], self._plug['index'])
+        return self.coordinator.uniqueId(self._plug.moduleAddress, self._plug.index)
 
     @property
     def device_extra_attributes(self):
         """Return device specific state attributes."""
-        return self._plug
+        return asdict(self._plug)
     
     @property
     def name(self):
         """Return the display name of this plug."""
-        return self._name
+        return self._plug.name
 
     @property
     def device_class(self):
@@ -62,20 +77,20 @@ class HomeAssistantDobissPlug(CoordinatorEntity, SwitchEntity):
     @property
     def is_on(self):
         """Return true if the plug is on."""
-        val = self.coordinator.data[self._plug['moduleAddress']][self._plug['index']]
+        val = self._values[self._index]
         return (val > 0)
 
     async def async_turn_on(self, **kwargs):
         """Instruct the plug to switch on.
         """
-        self.dobiss.setOn(self._plug['moduleAddress'], self._plug['index'])
+        confirmed = await self.dobiss.setOn(self._plug.moduleAddress, self._plug.index)
 
-        # Poll states
-        await self.coordinator.async_request_refresh()
+        # Show the new state if the controller echoed the command, and verify it
+        await self.coordinator.applyCommand(self._plug.moduleAddress, self._plug.index, 100, confirmed)
 
     async def async_turn_off(self, **kwargs):
         """Instruct the plug to turn off."""
-        self.dobiss.setOff(self._plug['moduleAddress'], self._plug['index'])
+        confirmed = await self.dobiss.setOff(self._plug.moduleAddress, self._plug.index)
 
-        # Poll states
-        await self.coordinator.async_request_refresh()
+        # Show the new state if the controller echoed the command, and verify it
+        await self.coordinator.applyCommand(self._plug.moduleAddress, self._plug.index, 0, confirmed)
@@ -6,6 +6,8 @@ DEFAULT_IP = "192.168.1.119"
 DEFAULT_PORT = 10001
 
 # IP address of the installation
+# Without an installation, start the stand-in controller first (python simulator.py)
+# and run this script with 127.0.0.1 as IP address
 ip = DEFAULT_IP
 if len(sys.argv) > 1:
     ip = str(sys.argv[1])
@@ -0,0 +1,211 @@
+"""
+Tests of the RecvBuffer and ResponseParser with the byte sequences a real controller produces:
+stray and dropped bytes, and status reports interleaved with the responses of a burst.
+
+Run with:
+    python -m pytest tests
+"""
+
+import os
+import sys
+
+# The protocol modules are used standalone, like the scripts next to them
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "custom_components", "dobiss"))
+
+from capture import CaptureWriter, ReplayDobissSystem
+from codec import actionHeader, statusRequest
+from dobiss import RecvBuffer, ResponseParser
+from simulator import RELAIS, DIMMER, SimulatedModule, pad
+
+
+Result = ResponseParser.Result
+
+
+def module(address, values, moduleType = RELAIS):
+    """A simulated module with the given output values."""
+    simulated = SimulatedModule(address, moduleType)
+    simulated.values[:len(values)] = bytes(values)
+    return simulated
+
+def response(simulated):
+    """The echo of the status request of a module followed by its status, as the controller sends it."""
+    return pad(simulated.statusFrame()) + pad(simulated.statusData())
+
+def request(simulated):
+    """The status request of a module as a (frame, responseSize) request."""
+    return (statusRequest(simulated.address, simulated.type), 16)
+
+def parser(*chunks, reports = None):
+    """A parser of the given received chunks; reports collects the (module address, status) of the reports."""
+    buffer = RecvBuffer()
+    for chunk in chunks:
+        buffer.feed(chunk)
+
+    responseParser = ResponseParser(buffer)
+    if reports is not None:
+        responseParser.onReport = lambda frame, data: reports.append((frame[3], bytes(data)))
+    return responseParser
+
+def parseAll(responseParser, requests):
+    """Parse the responses to a burst of requests, as (result, response data)."""
+    results = [ ]
+    for index, (data, responseSize) in enumerate(requests):
+        result, response = responseParser.parse(data, responseSize, requests[index + 1:])
+        results.append((result, bytes(response) if response is not None else None))
+    return results
+
+
+def test_response():
+    first = module(1, [ 1, 0, 1 ])
+    responseParser = parser(response(first))
+
+    assert parseAll(responseParser, [ request(first) ]) == [ (Result.Complete, first.statusData()) ]
+    assert responseParser.stats == { 'resyncs': 0, 'lostResponses': 0, 'skippedBytes': 0, 'reports': 0 }
+    assert len(responseParser.buffer) == 0
+
+def test_incompleteResponse():
+    first = module(1, [ 1 ])
+    data = response(first)
+    responseParser = parser(data[:40])
+
+    assert responseParser.parse(*request(first)) == (Result.Incomplete, None)
+
+    responseParser.buffer.feed(data[40:])
+    result, status = responseParser.parse(*request(first))
+    assert result == Result.Complete
+    assert bytes(status) == first.statusData()
+
+def test_strayByte():
+    first, second = module(1, [ 1 ]), module(2, [ 0, 1 ])
+    responseParser = parser(b'\x00' + response(first), response(second))
+
+    assert parseAll(responseParser, [ request(first), request(second) ]) == [
+        (Result.Complete, first.statusData()),
+        (Result.Complete, second.statusData())
+    ]
+    assert responseParser.stats == { 'resyncs': 1, 'lostResponses': 0, 'skippedBytes': 1, 'reports': 0 }
+
+def test_droppedByte():
+    first, second = module(1, [ 1 ]), module(2, [ 0, 1 ])
+
+    # A byte of the echo of the first request is missing: only that response is lost
+    broken = response(first)
+    responseParser = parser(broken[:5] + broken[6:], response(second))
+
+    assert parseAll(responseParser, [ request(first), request(second) ]) == [
+        (Result.Lost, None),
+        (Result.Complete, second.statusData())
+    ]
+    assert responseParser.stats == { 'resyncs': 1, 'lostResponses': 1, 'skippedBytes': len(broken) - 1, 'reports': 0 }
+
+def test_reportInBurst():
+    first, second, other = module(1, [ 1 ]), module(2, [ 0, 1 ]), module(3, [ 40 ], DIMMER)
+    reports = [ ]
+    responseParser = parser(response(first), response(other), response(second), reports = reports)
+
+    assert parseAll(responseParser, [ request(first), request(second) ]) == [
+        (Result.Complete, first.statusData()),
+        (Result.Complete, second.statusData())
+    ]
+    assert reports == [ (3, other.statusData()) ]
+    assert responseParser.stats == { 'resyncs': 0, 'lostResponses': 0, 'skippedBytes': 0, 'reports': 1 }
+
+def test_reportLikeLaterEcho():
+    first, second = module(1, [ 1 ]), module(2, [ 0, 1 ])
+
+    # The report of the second module comes before the response to the first request,
+    # and looks just like the echo of the second request
+    reported = module(2, [ 1, 1 ])
+    reports = [ ]
+    responseParser = parser(response(reported), response(first), response(second), reports = reports)
+
+    assert parseAll(responseParser, [ request(first), request(second) ]) == [
+        (Result.Complete, first.statusData()),
+        (Result.Complete, second.statusData())
+    ]
+    assert reports == [ (2, reported.statusData()) ]
+    assert responseParser.stats == { 'resyncs': 0, 'lostResponses': 0, 'skippedBytes': 0, 'reports': 1 }
+
+def test_lostResponseIsNoReport():
+    first, second = module(1, [ 1 ]), module(2, [ 0, 1 ])
+    action = (actionHeader(2), 0)
+
+    # The response to the first request is missing. Until more data arrives, the second response
+    # could still be a report followed by the first response
+    reports = [ ]
+    responseParser = parser(response(second), reports = reports)
+    assert responseParser.parse(*request(first), [ request(second), action ]) == (Result.Incomplete, None)
+
+    # The echo of the action tells it was not a report
+    responseParser.buffer.feed(pad(action[0]))
+    assert parseAll(responseParser, [ request(first), request(second), action ]) == [
+        (Result.Lost, None),
+        (Result.Complete, second.statusData()),
+        (Result.Complete, b'')
+    ]
+    assert reports == [ ]
+    assert responseParser.stats == { 'resyncs': 1, 'lostResponses': 1, 'skippedBytes': 0, 'reports': 0 }
+
+def test_lostResponseInStatusBurst():
+    first, second, third = module(1, [ 1 ]), module(2, [ 0, 1 ]), module(3, [ 1, 1 ])
+
+    # Only the responses to the later requests follow, in order: the first response was lost
+    reports = [ ]
+    responseParser = parser(response(second), response(third), reports = reports)
+
+    assert parseAll(responseParser, [ request(first), request(second), request(third) ]) == [
+        (Result.Lost, None),
+        (Result.Complete, second.statusData()),
+        (Result.Complete, third.statusData())
+    ]
+    assert reports == [ ]
+    assert responseParser.stats == { 'resyncs': 1, 'lostResponses': 1, 'skippedBytes': 0, 'reports': 0 }
+
+def test_ambiguousResponseAtDeadline():
+    first, second, third = module(1, [ 1 ]), module(2, [ 0, 1 ]), module(3, [ 1, 1 ])
+    requests = [ request(first), request(second), request(third) ]
+
+    # Two responses are missing: the third response could still be a report, until no more data arrives
+    reports = [ ]
+    responseParser = parser(response(third), reports = reports)
+    assert responseParser.parse(*requests[0], requests[1:]) == (Result.Incomplete, None)
+    assert responseParser.parse(*requests[0], requests[1:], final = True) == (Result.Lost, None)
+
+    assert parseAll(responseParser, requests[1:]) == [
+        (Result.Lost, None),
+        (Result.Complete, third.statusData())
+    ]
+    assert reports == [ ]
+    assert responseParser.stats == { 'resyncs': 2, 'lostResponses': 2, 'skippedBytes': 0, 'reports': 0 }
+
+def test_replayCapture(tmp_path):
+    first, second = module(1, [ 1 ]), module(2, [ 0, 1 ])
+    path = str(tmp_path / "glitch.cap")
+
+    # A burst of two status requests, answered in odd chunks with a stray byte in between
+    writer = CaptureWriter(path)
+    writer.sent(request(first)[0] + request(second)[0])
+    data = response(first) + b'\x00' + response(second)
+    writer.received(data[:20])
+    writer.received(data[20:70])
+    writer.received(data[70:])
+    writer.close()
+
+    system = ReplayDobissSystem(path, speed = 0)
+    assert system.replay() == (2, 2)
+    assert system.parser.stats == { 'resyncs': 1, 'lostResponses': 0, 'skippedBytes': 1, 'reports': 0 }
+
+def test_replayCaptureWithReports(tmp_path):
+    first, second, other = module(1, [ 1 ]), module(2, [ 0, 1 ]), module(3, [ 40 ], DIMMER)
+    path = str(tmp_path / "reports.cap")
+
+    # A report arrives in the middle of a burst, like Home Assistant receives it while listening
+    writer = CaptureWriter(path)
+    writer.sent(request(first)[0] + request(second)[0])
+    writer.received(response(first) + response(other)[:40])
+    writer.received(response(other)[40:] + response(second))
+    writer.close()
+
+    system = ReplayDobissSystem(path, speed = 0, listen = True)
+    assert system.replay() == (2, 2)
+    assert system.parser.stats == { 'resyncs': 0, 'lostResponses': 0, 'skippedBytes': 0, 'reports': 1 }